@@ -1,11 +1,14 @@
 from pylons import request, response
 
-import simplejson
 from sqlalchemy import sqlalchemy as sa
 
 from pylons_common.lib.exceptions import *
-from pylons_common.web.response import ajax, FORMAT_JSON
-import time, sys, cgi
+from pylons_common.lib import serialize
+from pylons_common.web.response import ajax, FORMAT_JSON, ERROR_HTTP_STATUS, NOT_MODIFIED, ETAG_ENVIRON_KEY, etag_matches
+from pylons_common.lib.stats import api_stats
+from pylons_common.lib.timeline import get_timeline, timer
+from pylons_common.sqlalchemy import proxy
+import time, sys, cgi, random, datetime, decimal, hashlib
 
 from pylons_common.lib.log import create_logger
 logger = create_logger('pylons_common.controllers')
@@ -34,22 +37,79 @@ class ApiMixin(object):
     """
     ID_CONNECTOR_PARAM = ID_CONNECTOR_PARAM
     REAL_USER_PARAM = REAL_USER_PARAM 
+    
+    # Fraction of dispatched calls that count their queries and db time into
+    # pylons_common.lib.stats.api_stats. 1 samples everything. Needs the engine to use TimerProxy.
+    QUERY_SAMPLE_RATE = 0
+    
+    # Send ETags on GET dispatches and answer If-None-Match with a 304. The ETag comes from the
+    # function's @etag version hint if it has one (and then the function isnt even called on a
+    # match), otherwise from a hash of the response body.
+    USE_ETAGS = False
+    
+    # Most operations one batch() request can run
+    MAX_BATCH_OPERATIONS = 50
+    
+    # A pylons_common.lib.calllog.CallLogBuffer. When set, dispatch puts make_call_record()'s
+    # record in it instead of calling log_call, and it gets written in bulk off the request thread.
+    call_log_buffer = None
+    
+    # A pylons_common.lib.cache.ResponseCache. When set, results of @cacheable functions are
+    # cached in it, and @invalidates functions invalidate them.
+    response_cache = None
 
+    def get_route_registry(self):
+        """
+        Returns the ApiRouteRegistry shared by every controller with this module and
+        signature base.
+        """
+        return get_route_registry(self.API_MODULE_BASE, self.API_SIGNATURE_BASE)
+    
+    def make_call_record(self, real_user, auth_type, version, module, function, request_params, response_code, message, run_time, domain, user_agent):
+        """
+        The record handed to call_log_buffer. Override to shape it for your table. It gets
+        written after the request is over, so dont put anything request-bound (like the user
+        object) in here.
+        """
+        return {
+            'real_user_id': real_user and getattr(real_user, 'id', None),
+            'auth_type': auth_type,
+            'version': version,
+            'module': module,
+            'function': function,
+            'request_params': request_params and serialize.dumps(request_params, compact=True),
+            'response_code': response_code,
+            'message': message,
+            'run_time': run_time,
+            'domain': domain,
+            'user_agent': user_agent
+        }
+    
     def log_call(self, real_user, auth_type, version, module, function, request_params, response_code, message, run_time, domain, user_agent):
         logger.info('Ran %s.%s in %d ms' % (module, function, run_time))
     
+    def record_call(self, *call):
+        """
+        Hands the call to call_log_buffer if there is one, otherwise to log_call.
+        """
+        if self.call_log_buffer:
+            self.call_log_buffer.add(self.make_call_record(*call))
+        else:
+            self.log_call(*call)
+    
     def authenticate(self):
         """
         override this!
         """
         return None, None, None
 
-    def prologue(self, real_user, user, version, module, function=None, eid=None, id=None):
+    def prologue(self, real_user, user, version, module, function=None, eid=None, id=None, params=None):
         """
         Gather all data necessary to properly execute the target API function.
         If anything fatal occurs here, an ApiPrologueException is thrown,
         which ultimately results in the API call being aborted
         
+        params are the function's arguments; request.params if not specified.
         """
         # Allow a more RESTful usage, such as DELETE /api/v1/campaign/abc123 HTTP/1.1
         # instead of GET /api/v1/campaign/delete/abc123 HTTP/1.1
@@ -65,35 +125,23 @@ class ApiMixin(object):
         except ValueError, e:
             raise ApiPrologueException(501, "Invalid version '%s'" % version, INVALID)
 
-        # Find the requested function in the API.  If not found, bail out.
-        fn = import_symbol('.'.join([self.API_MODULE_BASE, module]), function)
-        
-        # Map the id url part to a parameter name in the function. e.g. a function
-        # on the ad module might set ID_PARAM = 'ad'. Then the user could specify
-        # def edit(blah, ad, blah2=False)
-        # And the id field in the url will get passed into the ad parameter.
-        id_param = import_symbol('.'.join([self.API_MODULE_BASE, module]), ID_CONNECTOR_PARAM)
+        # Find the requested function and its signature shim. The registry resolves each
+        # (version, module, function) once and caches the result, misses included.
+        route = self.get_route_registry().resolve(version, module, function)
+        fn, sig, id_param, signature = route.fn, route.sig, route.id_param, route.signature
         
-        try:
-            sig = get_sig(version, self.API_SIGNATURE_BASE, module, function)
-        except ImportError:
-            raise ApiPrologueException(501, "Version %d not implemented yet" % (version), NOT_FOUND)
-            
         # Instantiate the shim class, which may contain an 'input' and/or 'output' function
         # to mangle the args to- and return value from- the underlying API method.
-        if not (fn and sig):
-            raise ApiPrologueException(501, "%s.%s not implemented" % (module, function), NOT_FOUND)
-
         shim = sig()
-
-        signature = hasattr(fn, 'original_varnames') and fn.original_varnames or fn.func_code.co_varnames
         
         args = {}
         if id_param and id_param in signature and id:
             args[id_param] = id
         
         # args can override
-        args.update(dict(request.params.iteritems()))
+        if params is None:
+            params = request.params
+        args.update(dict(params.iteritems()))
         
         # Pass in the current user, if that's a valid argument to this function
         # Put the users in here so we dont open a giant security hole.
@@ -114,6 +162,89 @@ class ApiMixin(object):
         
         return fn, args, id_param, shim
     
+    def get_etag(self, fn, args):
+        """
+        The ETag from fn's version hint, or None if it doesnt have one. It is per user when fn
+        takes a user: the 304 goes out before any permission checks in fn.
+        """
+        etag_fn = getattr(fn, 'etag', None)
+        if not etag_fn:
+            return None
+        
+        hint = etag_fn(**args)
+        if hint is None:
+            return None
+        
+        # prologue only puts the user in args when it is in fn's signature
+        user_id = getattr(args.get('user'), 'id', None)
+        
+        if isinstance(hint, unicode):
+            hint = hint.encode('utf-8')
+        return '"%s"' % hashlib.md5('%s.%s.%s.%s' % (fn.__module__, fn.__name__, user_id, hint)).hexdigest()
+    
+    def get_cache_key(self, fn, version, module, args, user, per_user=True):
+        """
+        The response_cache key for calling fn with args, or None if the args arent simple enough
+        to make one (files and the like).
+        """
+        params = []
+        for k, v in args.iteritems():
+            if k in ['user', self.REAL_USER_PARAM]:
+                continue
+            if not isinstance(v, (basestring, int, long)):
+                return None
+            params.append((k, v))
+        params.sort()
+        
+        user_id = per_user and user and getattr(user, 'id', None) or None
+        return self.response_cache.make_key(version, module, fn.__module__, fn.__name__, params, user_id)
+    
+    def format_cache_tags(self, tags, args):
+        """
+        Fills in @cacheable and @invalidates tag templates from args. Tags needing an arg that
+        wasnt passed are left out.
+        """
+        formatted = []
+        for tag in tags:
+            try:
+                formatted.append(tag % args)
+            except KeyError:
+                pass
+        return formatted
+    
+    def cache_get(self, key, tags):
+        """
+        response_cache.get, where a broken backend is a miss instead of a failed call.
+        """
+        try:
+            return self.response_cache.get(key, tags)
+        except Exception:
+            logger.exception('Response cache get failed')
+            return None
+    
+    def cache_set(self, key, value, ttl, tags):
+        """
+        response_cache.set, for concrete values only. Generators and queries get streamed, so
+        they would come back used up (or not pickle at all).
+        
+        What gets cached is a json copy of value. Model instances in it would be detached once
+        the session commits, and a local backend would hand the same object to every thread.
+        """
+        if not isinstance(value, CACHEABLE_TYPES):
+            return
+        try:
+            self.response_cache.set(key, serialize.loads(serialize.dumps(value, compact=True)), ttl, tags)
+        except Exception:
+            logger.exception('Response cache set failed')
+    
+    def cache_invalidate(self, tags):
+        if not tags:
+            return
+        try:
+            self.response_cache.invalidate(*tags)
+        except Exception:
+            logger.exception('Response cache invalidate failed for %s' % tags)
+    
     def epilogue(self, shim, results):
         """
         If the sig defines an output function, transform results with it.
@@ -138,18 +269,61 @@ class ApiMixin(object):
         params = dict(request.params)
         domain = request.environ.get("X_FORWARDED_FOR", request.environ["REMOTE_ADDR"]) or request.headers.get('Origin')
         real_user = auth_type = api_function = request_params = None
+        invalidate_tags = None
         app_exception = None
         run_time = 0    
         
+        endpoint = None
+        if self.QUERY_SAMPLE_RATE and random.random() < self.QUERY_SAMPLE_RATE:
+            proxy.start_sample()
+        
+        timeline = get_timeline(request.environ)
+        t = timer()
+        
         try:
             user, real_user, auth_type = self.authenticate()
+            t = timeline.mark('authenticate', t)
             
             fn, args, id_param, shim = self.prologue(real_user, user, version, module, function=function, eid=eid, id=id)
+            t = timeline.mark('prologue', t)
             api_function = u'.'.join([fn.__module__, module, fn.__name__])
+            endpoint = u'.'.join([module, fn.__name__])
+            proxy.set_api_function(api_function)
             
-            results = fn(**args)
-            self.Session.flush()
-            api_response = self.epilogue(shim, results)
+            if self.USE_ETAGS and request.method == 'GET':
+                etag = self.get_etag(fn, args)
+                if etag and etag_matches(request.headers.get('If-None-Match'), etag):
+                    # returning from here skips the status code at the bottom, so set it now
+                    response_code = response.status = 304
+                    response.headers['ETag'] = etag
+                    return NOT_MODIFIED
+                elif etag:
+                    response.headers['ETag'] = etag
+                else:
+                    request.environ[ETAG_ENVIRON_KEY] = True
+            
+            cache_key = cache_tags = None
+            cache_options = self.response_cache and getattr(fn, 'cache_options', None)
+            if cache_options:
+                cache_key = self.get_cache_key(fn, version, module, args, user, cache_options['per_user'])
+                cache_tags = self.format_cache_tags(cache_options['tags'], args)
+            if cache_key:
+                api_response = self.cache_get(cache_key, cache_tags)
+                t = timeline.mark('cache', t)
+            
+            if api_response is None:
+                results = fn(**args)
+                t = timeline.mark('api', t, exclude=['enforce'])
+                self.Session.flush()
+                t = timeline.mark('flush', t)
+                api_response = self.epilogue(shim, results)
+                t = timeline.mark('epilogue', t)
+                
+                if cache_key:
+                    self.cache_set(cache_key, api_response, cache_options['ttl'], cache_tags)
+            
+            if self.response_cache and getattr(fn, 'invalidates', None):
+                invalidate_tags = self.format_cache_tags(fn.invalidates, args)
             
             if args.has_key(id_param):
                 params[id_param] = args[id_param]
@@ -170,7 +344,7 @@ class ApiMixin(object):
         except ApiValueException, (e):
             # At least one value passed to the API couldn't be converted to the expected type.  Communicate this.
             response_code = 500
-            message = unicode(simplejson.dumps(e.errors))
+            message = unicode(serialize.dumps(e.errors))
             api_response = {'errors': e.errors}
         
         except Exception, (e):
@@ -184,26 +358,197 @@ class ApiMixin(object):
         finally:
             run_time = int((time.time() - start_time) * 1000)
             
-            self.log_call(real_user, auth_type,
-                          unicode(version), module, function, request_params,
-                          response_code, message, run_time, unicode(domain),
-                          unicode(request.headers.get('User-Agent')))
+            proxy.set_api_function(None)
+            sample = proxy.end_sample()
+            if sample and endpoint:
+                api_stats.record(endpoint, sample.queries, sample.time * 1000, run_time)
+            
+            self.record_call(real_user, auth_type,
+                             unicode(version), module, function, request_params,
+                             response_code, message, run_time, unicode(domain),
+                             unicode(request.headers.get('User-Agent')))
             
             logger.info('Committing')
+            t = timer()
             self.commit()
+            timeline.mark('commit', t)
             
             #reraise any exceptions so that the error middleware can handle them
             if app_exception:
                 raise
         
+        # only once the changes are committed, or a request could cache the old data again
+        if response_code == 200:
+            self.cache_invalidate(invalidate_tags)
+        
         response.status = response_code
         response.headers['X-Runtime-Ms'] = u'%d' % run_time
         return api_response
+    
+    @ajax
+    def batch(self, version):
+        """
+        Runs several api calls in one request, authenticating once. The 'operations' param is a
+        json list of {"module": ..., "function": ..., "params": {...}, "id": ...}. Each runs
+        through prologue/epilogue like dispatch. The results are a list with one
+        {"code": ..., "results": ...} or {"code": ..., "errors": [...]} per operation, in order.
+        
+        By default each operation is committed (or rolled back) on its own. With atomic=true
+        they all are committed together, or all rolled back as soon as one fails, in which case
+        the operations after it are not run. The ones before it get a 424 too, since their
+        changes are gone.
+        
+        @invalidates tags are invalidated once the operation's changes are committed.
+        """
+        start_time = time.time()
+        
+        try:
+            operations = serialize.loads(request.params.get('operations') or '[]')
+        except ValueError:
+            operations = None
+        if not isinstance(operations, list):
+            return fail(400, "operations must be a json list", INVALID)
+        if len(operations) > self.MAX_BATCH_OPERATIONS:
+            return fail(400, "At most %d operations per batch" % self.MAX_BATCH_OPERATIONS, INVALID)
+        
+        atomic = request.params.get('atomic', '').lower() in ['t','true','1','y','yes','on']
+        domain = request.environ.get("X_FORWARDED_FOR", request.environ["REMOTE_ADDR"]) or request.headers.get('Origin')
+        
+        try:
+            user, real_user, auth_type = self.authenticate()
+        except:
+            self.Session.rollback()
+            raise
+        
+        results = []
+        calls = []
+        failed = False
+        invalidate_tags = []
+        for operation in operations:
+            if failed and atomic:
+                results.append({'code': 424, 'errors': [{'message': 'Not run, an earlier operation failed', 'code': FAIL}]})
+                continue
+            
+            tags = []
+            result, call = self.run_operation(real_user, user, auth_type, version, operation, domain, tags)
+            results.append(result)
+            
+            ok = result['code'] == 200
+            failed = failed or not ok
+            if atomic:
+                calls.append(call)
+                if ok:
+                    invalidate_tags.extend(tags)
+                continue
+            
+            # like dispatch: roll back before the call is logged, then commit the log
+            if not ok:
+                self.Session.rollback()
+            self.record_call(*call)
+            self.commit()
+            if ok:
+                self.cache_invalidate(tags)
+        
+        if atomic:
+            if failed:
+                self.Session.rollback()
+                
+                # the ones that worked didnt stick either
+                message = 'Rolled back, a later operation failed'
+                for result, call in zip(results, calls):
+                    if result['code'] == 200:
+                        result.pop('results', None)
+                        result['code'] = 424
+                        result['errors'] = [{'message': message, 'code': FAIL}]
+                        call[6:8] = [424, message] # response_code, message
+            
+            for call in calls:
+                self.record_call(*call)
+            self.commit()
+            
+            if not failed:
+                self.cache_invalidate(invalidate_tags)
+        
+        response.headers['X-Runtime-Ms'] = u'%d' % int((time.time() - start_time) * 1000)
+        return results
+    
+    def run_operation(self, real_user, user, auth_type, version, operation, domain, invalidate_tags=None):
+        """
+        Runs one batch operation. Returns its result dict and the arguments for record_call.
+        Nothing is committed, rolled back or logged here; that is up to the caller. If it
+        succeeds, the response_cache tags it invalidates are added to invalidate_tags for the
+        caller to invalidate after committing.
+        
+        Unexpected exceptions dont get to the error middleware, so they are handed to its
+        reporters here.
+        """
+        start_time = time.time()
+        
+        operation = isinstance(operation, dict) and operation or {}
+        module = operation.get('module')
+        function = operation.get('function')
+        params = None
+        
+        response_code = 200
+        message = None
+        try:
+            if not (module and function):
+                raise ApiPrologueException(400, "Operations need a module and a function", INVALID)
+            params = batch_params(operation.get('params') or {})
+            
+            fn, args, id_param, shim = self.prologue(real_user, user, version, module,
+                                                     function=function, id=operation.get('id'), params=params)
+            results = fn(**args)
+            self.Session.flush()
+            result = {'results': self.epilogue(shim, results)}
+            
+            if invalidate_tags is not None and self.response_cache and getattr(fn, 'invalidates', None):
+                invalidate_tags.extend(self.format_cache_tags(fn.invalidates, args))
+        
+        except ApiPrologueException, (e):
+            response_code = e.http_response_code
+            message = e.msg
+            result = {'errors': [{'message': e.msg, 'code': e.error_code}]}
+        
+        except ApiValueException, (e):
+            response_code = 500
+            message = unicode(serialize.dumps(e.errors))
+            result = {'errors': e.errors}
+        
+        except ClientException, (e):
+            response_code = ERROR_HTTP_STATUS.get(e.code, 400)
+            message = e.msg
+            result = {'errors': [client_error(e)]}
+        
+        except CompoundException, (e):
+            response_code = 400
+            message = e.msg
+            result = {'errors': [client_error(ce) for ce in e.exceptions]}
+        
+        except Exception, (e):
+            logger.exception('Batch operation %s.%s failed' % (module, function))
+            from pylons_common.middleware.errors import report_exception
+            report_exception(request.environ)
+            
+            response_code = 500
+            message = unicode(e)
+            result = {'errors': [{'message': 'Internal Server Error', 'code': FAIL}]}
+        
+        call = [real_user, auth_type,
+                unicode(version), module, function, params,
+                response_code, message, int((time.time() - start_time) * 1000), unicode(domain),
+                unicode(request.headers.get('User-Agent'))]
+        
+        result['code'] = response_code
+        return result, call
 
 ##
 ## Helper functions
 ##
 
+# What ApiMixin.cache_set will store
+CACHEABLE_TYPES = (dict, list, tuple, basestring, int, long, float, decimal.Decimal, datetime.date)
+
 def default_return_fn(results):
     if hasattr(results, '__class__'):
         klass = results.__class__
@@ -214,6 +559,38 @@ def default_return_fn(results):
                 return {'%s_id' % klass.__name__.lower() : results.id}
     return results
 
+def client_error(ce):
+    err = {'value': ce.value, 'message': ce.msg, 'code': ce.code}
+    if ce.field:
+        err['field'] = ce.field
+    return err
+
+def batch_params(params):
+    """
+    Batch params come in as json. Turn them back into the strings a query string would
+    have given us so enforce treats them the same. Lists become comma-delimited.
+    Raises an ApiPrologueException if they arent a json object of ascii names.
+    """
+    if not isinstance(params, dict):
+        raise ApiPrologueException(400, "Operation params must be a json object", INVALID)
+    
+    converted = {}
+    for k, v in params.iteritems():
+        try:
+            k = str(k)
+        except UnicodeEncodeError:
+            raise ApiPrologueException(400, "Invalid param name %r" % k, INVALID)
+        if v is None:
+            continue
+        if isinstance(v, list):
+            v = u','.join(unicode(e) for e in v)
+        elif isinstance(v, dict):
+            v = serialize.dumps(v)
+        elif isinstance(v, bool):
+            v = v and u'true' or u'false'
+        converted[k] = unicode(v)
+    return converted
+
 def fail(http_code, message, error_code):
     response.status = http_code
     return {'errors': [{'message': message, 'code': error_code}]}
@@ -238,4 +615,121 @@ def import_symbol(module_name, symbol_name):
         module = sys.modules.get(module_name)
     return getattr(module, symbol_name, None)
 
+##
+## Route registry
+##
+
+# Unknown routes are cached too, but only up to this many before the negative cache is reset.
+# Keeps garbage urls from growing the cache forever.
+MAX_NEGATIVE_ROUTES = 1000
+
+class ApiRoute(object):
+    """
+    A resolved (version, module, function) triple. Everything prologue needs that doesn't
+    change between requests.
+    """
+    __slots__ = ['fn', 'sig', 'id_param', 'signature']
+    
+    def __init__(self, fn, sig, id_param):
+        self.fn = fn
+        self.sig = sig
+        self.id_param = id_param
+        self.signature = frozenset(hasattr(fn, 'original_varnames') and fn.original_varnames or fn.func_code.co_varnames)
+
+class ApiRouteRegistry(object):
+    """
+    Caches the api function, signature shim class and ID_PARAM for each
+    (version, module, function) so we only do the imports once. Routes are resolved
+    lazily on first hit, or all at once with load().
+    """
+    def __init__(self, module_base, signature_base):
+        self.module_base = module_base
+        self.signature_base = signature_base
+        self.routes = {}
+        self.missing = {}
+    
+    def resolve(self, version, module, function):
+        """
+        Returns the ApiRoute for the call or raises ApiPrologueException.
+        """
+        key = (version, module, function)
+        
+        route = self.routes.get(key)
+        if route:
+            return route
+        
+        error = self.missing.get(key)
+        if error:
+            raise error
+        
+        try:
+            route = self.build_route(version, module, function)
+        except ApiPrologueException, e:
+            if len(self.missing) >= MAX_NEGATIVE_ROUTES:
+                self.missing.clear()
+            self.missing[key] = e
+            raise
+        
+        self.routes[key] = route
+        return route
+    
+    def build_route(self, version, module, function):
+        if not function:
+            raise ApiPrologueException(501, "%s.%s not implemented" % (module, function), NOT_FOUND)
+        
+        module_name = '.'.join([self.module_base, module])
+        fn = import_symbol(module_name, function)
+        
+        # Map the id url part to a parameter name in the function. e.g. a function
+        # on the ad module might set ID_PARAM = 'ad'. Then the user could specify
+        # def edit(blah, ad, blah2=False)
+        # And the id field in the url will get passed into the ad parameter.
+        id_param = import_symbol(module_name, ID_CONNECTOR_PARAM)
+        
+        try:
+            sig = get_sig(version, self.signature_base, module, function)
+        except ImportError:
+            raise ApiPrologueException(501, "Version %d not implemented yet" % (version), NOT_FOUND)
+        
+        if not (fn and sig):
+            raise ApiPrologueException(501, "%s.%s not implemented" % (module, function), NOT_FOUND)
+        
+        return ApiRoute(fn, sig, id_param)
+    
+    def load(self):
+        """
+        Walks every vN package under the signature base and resolves every shim class that has
+        a matching api function. Call at startup to keep the imports off the request path.
+        """
+        import pkgutil, inspect
+        
+        base = __import__(self.signature_base, fromlist=['__path__'])
+        for loader, vm_name, is_pkg in pkgutil.iter_modules(base.__path__):
+            if not (vm_name.startswith('v') and vm_name[1:].isdigit()):
+                continue
+            
+            version = int(vm_name[1:])
+            vm = __import__('.'.join([self.signature_base, vm_name]), fromlist=[vm_name])
+            for module_name in dir(vm):
+                sig_module = getattr(vm, module_name)
+                if not inspect.ismodule(sig_module):
+                    continue
+                
+                for function, sig in inspect.getmembers(sig_module, inspect.isclass):
+                    if sig.__module__ != sig_module.__name__:
+                        continue
+                    try:
+                        self.resolve(version, module_name, function)
+                    except ApiPrologueException:
+                        pass
+        
+        return self.routes
+
+_route_registries = {}
 
+def get_route_registry(module_base, signature_base):
+    key = (module_base, signature_base)
+    registry = _route_registries.get(key)
+    if not registry:
+        registry = _route_registries.setdefault(key, ApiRouteRegistry(module_base, signature_base))
+    return registry
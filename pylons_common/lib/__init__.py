@@ -1,4 +1,4 @@
-from pylons_common.lib.date import get_timezones
+from pylons_common.lib.date import get_timezones, get_timezone_offset, get_offset_timezone
 from pylons_common.lib.utils import *
 
 import log
@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+import uuid as uuid_mod
+
+"""
+Caching for api function results. See the @cacheable and @invalidates decorators in
+pylons_common.lib.decorators; ApiMixin.dispatch uses a ResponseCache when its
+response_cache is set:
+
+    class ApiController(BaseController, ApiMixin):
+        response_cache = ResponseCache()                                # in process
+        response_cache = ResponseCache(memcache.Client(['127.0.0.1:11211']))  # shared
+
+A backend is anything with get(key), set(key, value, ttl) and delete(key), which is what
+python-memcached's Client has. LRUCache is the in-process one.
+
+Invalidation is by tag. Every tag has a version stored in the backend, and the versions of
+an entry's tags are part of its key, so bumping a tag's version orphans every entry with
+that tag. The orphans age out on their own.
+"""
+
+__all__ = ['LRUCache', 'ResponseCache']
+
+class LRUCache(object):
+    """
+    In-process cache of at most capacity entries, least recently used evicted first.
+    """
+    def __init__(self, capacity=1000):
+        import collections
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                return None
+            # back on the end, it is the most recently used now
+            self.entries[key] = entry
+            return value
+        finally:
+            self.lock.release()
+    
+    def set(self, key, value, ttl=0):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, ttl and time.time() + ttl or 0)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+    
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+class ResponseCache(object):
+    """
+    Stores values under a key and a list of tags. Defaults to an LRUCache backend.
+    """
+    def __init__(self, backend=None, prefix='pcrc'):
+        self.backend = backend or LRUCache()
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+    
+    def make_key(self, *parts):
+        """
+        Backend safe key for parts. Memcached doesnt like long keys or spaces.
+        """
+        return '%s:%s' % (self.prefix, hashlib.md5(repr(parts)).hexdigest())
+    
+    def tag_version(self, tag):
+        key = self.make_key('tag', tag)
+        version = self.backend.get(key)
+        if version is None:
+            version = uuid_mod.uuid4().hex
+            self.backend.set(key, version, 0)
+        return version
+    
+    def versioned_key(self, key, tags):
+        if not tags:
+            return key
+        return self.make_key(key, [self.tag_version(tag) for tag in sorted(tags)])
+    
+    def get(self, key, tags=None):
+        value = self.backend.get(self.versioned_key(key, tags))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl=0, tags=None):
+        self.backend.set(self.versioned_key(key, tags), value, ttl)
+    
+    def invalidate(self, *tags):
+        """
+        Orphans everything cached with any of tags.
+        """
+        for tag in tags:
+            self.backend.set(self.make_key('tag', tag), uuid_mod.uuid4().hex, 0)
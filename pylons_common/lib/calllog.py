@@ -0,0 +1,134 @@
+import atexit
+import threading
+import time
+import Queue
+
+from pylons_common.lib import serialize
+from pylons_common.lib.log import create_logger
+logger = create_logger('pylons_common.lib.calllog')
+
+"""
+Gets api call logging off the request thread. ApiMixin.dispatch puts a record (a dict of
+log_call's arguments) into a CallLogBuffer, and a background thread hands them to a write
+function in batches:
+
+    class ApiController(BaseController, ApiMixin):
+        call_log_buffer = CallLogBuffer(insert_into(meta.engine, api_call_table))
+
+or
+
+        call_log_buffer = CallLogBuffer(append_to_file('/var/log/app/api_calls.log'))
+
+When the buffer is full, records are dropped and counted rather than making the request wait.
+"""
+
+__all__ = ['CallLogBuffer', 'insert_into', 'append_to_file']
+
+class CallLogBuffer(object):
+    """
+    A bounded buffer of call log records. A worker thread writes a batch when it has
+    batch_size records or interval seconds have passed since the first one came in.
+    """
+    capacity = 10000
+    batch_size = 500
+    interval = 5.0
+    
+    def __init__(self, write, capacity=None, batch_size=None, interval=None):
+        self.write = write
+        self.queue = Queue.Queue(capacity or self.capacity)
+        if batch_size:
+            self.batch_size = batch_size
+        if interval is not None:
+            self.interval = interval
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+    
+    def add(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def start(self):
+        if self.thread:
+            return
+        self.lock.acquire()
+        try:
+            if not self.thread:
+                thread = threading.Thread(target=self.run, name='CallLogBuffer')
+                thread.setDaemon(True)
+                thread.start()
+                self.thread = thread
+                # dont lose whatever is buffered on a normal shutdown
+                atexit.register(self.flush)
+        finally:
+            self.lock.release()
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            self.write_batch(batch)
+    
+    def flush(self):
+        """
+        Synchronously writes everything in the buffer.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+    
+    def write_batch(self, batch):
+        if self.dropped:
+            logger.warning('Dropped %d api call log records, the buffer was full' % self.dropped)
+            self.dropped = 0
+        
+        self.write_lock.acquire()
+        try:
+            self.write(batch)
+            self.written += len(batch)
+        except:
+            logger.exception('Failed to write %d api call log records' % len(batch))
+        finally:
+            self.write_lock.release()
+
+def insert_into(engine, table):
+    """
+    A write function that inserts the records into table with one executemany. The records'
+    keys need to match the table's columns.
+    """
+    def write(records):
+        engine.execute(table.insert(), records)
+    return write
+
+def append_to_file(filename):
+    """
+    A write function that appends the records to filename, one json object per line.
+    """
+    def write(records):
+        f = open(filename, 'ab')
+        try:
+            f.write(''.join(serialize.dumps(record, compact=True) + '\n' for record in records))
+        finally:
+            f.close()
+    return write
@@ -4,6 +4,7 @@ from pylons_common.lib.utils import pluralize
 
 logger = create_logger('pylons_common.lib.datetime')
 from datetime import datetime, timedelta
+import re
 
 DATE_FORMAT_ACCEPT = [u'%Y-%m-%d %H:%M:%S', u'%Y-%m-%d %H:%M:%SZ', u'%Y-%m-%d', u'%m-%d-%Y', u'%m/%d/%Y', u'%m.%d.%Y', u'%b %d, %Y']
 
@@ -14,6 +15,67 @@ popular_timezones = [u'US/Eastern', u'US/Central', u'US/Mountain', u'US/Pacific'
                      u'Australia/Brisbane', u'Australia/Sydney',
                      u'Pacific/Fiji']
 
+# The regexes strptime uses for the numeric directives. Formats made only of these get
+# parsed with our own compiled regex; anything else (%b is locale dependent) goes to strptime.
+STRPTIME_DIRECTIVES = {
+    'd': r"(?P<d>3[0-1]|[1-2]\d|0[1-9]|[1-9]| [1-9])",
+    'H': r"(?P<H>2[0-3]|[0-1]\d|\d)",
+    'm': r"(?P<m>1[0-2]|0[1-9]|[1-9])",
+    'M': r"(?P<M>[0-5]\d|\d)",
+    'S': r"(?P<S>6[0-1]|[0-5]\d|\d)",
+    'Y': r"(?P<Y>\d\d\d\d)"
+}
+
+def compile_format(format):
+    """
+    Compiles a strptime format into the regex strptime would match it with, or returns None
+    if it uses a directive not in STRPTIME_DIRECTIVES or doesnt have a whole date.
+    """
+    if not all(d in format for d in ['%Y', '%m', '%d']):
+        return None
+    
+    pattern = []
+    parts = re.split(r'(%.)', format)
+    for i, part in enumerate(parts):
+        if i % 2:
+            directive = STRPTIME_DIRECTIVES.get(part[1])
+            if not directive:
+                return None
+            pattern.append(directive)
+        else:
+            # strptime lets any run of whitespace in the format match any run in the value
+            pattern.append(r'\s+'.join(re.escape(p) for p in re.split(r'\s+', part)))
+    # \Z, not $: strptime wont take a trailing newline
+    return re.compile(''.join(pattern) + r'\Z', re.IGNORECASE)
+
+DATE_FORMAT_PATTERNS = [(format, compile_format(format)) for format in DATE_FORMAT_ACCEPT]
+
+MAX_CACHED_DATES = 5000
+_converted_dates = {}
+
+def parse_date(value):
+    """
+    Tries DATE_FORMAT_ACCEPT in order, like strptime on each would. None if none match.
+    """
+    for format, pattern in DATE_FORMAT_PATTERNS:
+        if pattern:
+            match = pattern.match(value)
+            if not match:
+                continue
+            fields = match.groupdict()
+            try:
+                return datetime(int(fields['Y']), int(fields['m']), int(fields['d']),
+                                int(fields.get('H') or 0), int(fields.get('M') or 0), int(fields.get('S') or 0))
+            except ValueError:
+                # out of range, Feb 30 and the like. strptime fails these too.
+                continue
+        else:
+            try:
+                return datetime.strptime(value, format)
+            except ValueError:
+                pass
+    return None
+
 def convert_date(value):
     """
     converts a string into a datetime object
@@ -25,58 +87,216 @@ def convert_date(value):
     if isinstance(value, datetime):
         return value
     
-    def try_parse(val, format):
-        try:
-            dt = datetime.strptime(val, format)
-        except ValueError:
-            dt = None
-        return dt
+    if not isinstance(value, basestring):
+        # strptime's TypeError
+        return datetime.strptime(value, DATE_FORMAT_ACCEPT[0])
+    
+    # the same few dates tend to come in over and over, and datetimes are immutable
+    converted_value = _converted_dates.get(value)
+    if converted_value is None:
+        converted_value = parse_date(value)
+        if converted_value:
+            if len(_converted_dates) >= MAX_CACHED_DATES:
+                _converted_dates.clear()
+            _converted_dates[value] = converted_value
     
-    converted_value = None
-    for format in DATE_FORMAT_ACCEPT:
-        converted_value = converted_value or try_parse(value, format)
     if not converted_value:
         raise ValueError('Cannot convert supposed date %s' % value)
     
     return converted_value
 
-def get_timezones():
-    import pytz
+def convert_date_strptime(value):
+    """
+    convert_date the old way, strptime with each format in turn. convert_date has to agree
+    with it; check_convert_date compares them.
+    """
+    if not value:
+        return None
     
-    timezones = {0:u'UTC'}
-    for tzname in pytz.common_timezones:
-        tzname = tzname.decode('utf-8')
-        tz = pytz.timezone(tzname)
-        
-        dt = datetime.utcnow()
+    if isinstance(value, datetime):
+        return value
+    
+    for format in DATE_FORMAT_ACCEPT:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('Cannot convert supposed date %s' % value)
 
-        # in theory, this is more elegant, but tz.dst (timezone daylight savings - 0 if off 1 if on) is returning 0 for everything
-        #offset = tz.utcoffset(dt) - tz.dst(dt)
+def sample_dates(n=10000, seed=0):
+    """
+    n strings shaped like the DATE_FORMAT_ACCEPT formats, with fields in and out of range,
+    odd whitespace and junk on the end. About a tenth of them are valid dates.
+    """
+    import random
+    r = random.Random(seed)
+    
+    def field(lo, hi):
+        value = r.randint(lo, hi)
+        return r.choice(['%d' % value, '%02d' % value, ' %d' % value])
+    
+    values = []
+    for i in range(n):
+        Y = r.choice(['%04d' % r.randint(0, 2100), '%d' % r.randint(0, 99999)])
+        m, d = field(0, 13), field(0, 32)
+        t = '%s:%s:%s' % (field(0, 25), field(0, 61), field(0, 62))
+        ws = r.choice([' ', '  ', '\t', ''])
+        value = r.choice([Y + '-' + m + '-' + d + ws + t, Y + '-' + m + '-' + d + ws + t + r.choice('Zz'),
+                          Y + '-' + m + '-' + d, m + '-' + d + '-' + Y, m + '/' + d + '/' + Y, m + '.' + d + '.' + Y,
+                          r.choice(['Jan', 'feb', 'DEC', 'Fob']) + ws + d + ',' + ws + Y])
+        value += r.choice(['', '', '', '', '\n', ' ', 'x'])
+        if r.random() < .3:
+            value = value.decode('ascii')
+        values.append(value)
+    return values
 
-        # we do this try/except to avoid the possibility that pytz fails at localization
-        # see https://bugs.launchpad.net/pytz/+bug/207500
+def check_convert_date(values=None):
+    """
+    Runs values (sample_dates() by default) through convert_date, twice so the memoized answer
+    is checked too, and convert_date_strptime. Returns [(value, expected, got)] for every value
+    they disagree on, where a failure is the exception's class.
+    """
+    def result(fn, value):
         try:
-            offset = dt.replace(tzinfo=pytz.utc) - tz.localize(dt)
-            seconds = offset.days * 86400 + offset.seconds
-            minutes = seconds / 60
-            hours = minutes / 60
-    
-            # adjust for offsets that are greater than 12 hours (these are repeats of other offsets)
-            if hours > 12:
-                hours = hours - 24
-            elif hours < -11:
-                hours = hours + 24
+            return fn(value)
+        except Exception, e:
+            return e.__class__
+    
+    if values is None:
+        values = sample_dates()
+    
+    mismatches = []
+    for value in values:
+        expected = result(convert_date_strptime, value)
+        for i in range(2):
+            got = result(convert_date, value)
+            if got != expected:
+                mismatches.append((value, expected, got))
+                break
+    return mismatches
+
+def benchmark(values=None, number=10):
+    """
+    Times converting values (a mix of valid sample_dates() by default) number times with
+    convert_date_strptime, parse_date (convert_date without the memo) and convert_date.
+    Returns {name: seconds}.
+    """
+    import timeit
+    
+    if values is None:
+        values = [v for v in sample_dates(5000) if parse_date(v)]
+    
+    def run(fn):
+        for value in values:
+            fn(value)
+    
+    times = {}
+    for name, fn in [('strptime', convert_date_strptime), ('parse_date', parse_date), ('convert_date', convert_date)]:
+        times[name] = timeit.Timer(lambda: run(fn)).timeit(number)
+        logger.info('%s: %.3fsec for %d runs of %d dates' % (name, times[name], number, len(values)))
+    return times
+
+def _next_transition(tz, now):
+    """
+    The first time after now (naive utc, used as tz's wall time the way TimezoneIndex does)
+    that localizing it in tz gives a different offset. None for zones without DST.
+    """
+    times = getattr(tz, '_utc_transition_times', None)
+    if not times:
+        return None
+    
+    import bisect
+    info = tz._transition_info
+    # offsets are under a day, so nothing before this can be in the future in wall time
+    first = max(bisect.bisect_right(times, now - timedelta(days=1)), 1)
+    for i in range(first, len(times)):
+        # localize switches offsets somewhere between the transition in the old and new wall time
+        for boundary in sorted([times[i] + info[i-1][0], times[i] + info[i][0]]):
+            if boundary > now:
+                return boundary
+    return None
+
+class TimezoneIndex(object):
+    """
+    get_timezones' offset (hours) to timezone dict as of now, and the reverse for every
+    common timezone. It is good until expires: the next utc hour, or sooner if a DST
+    boundary comes first.
+    """
+    def __init__(self, now=None):
+        import pytz
+        
+        self.now = dt = now or datetime.utcnow()
+        self.timezones = {0:u'UTC'}
+        self.offsets = {}
+        self.expires = dt.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        
+        for tzname in pytz.common_timezones:
+            tzname = tzname.decode('utf-8')
+            tz = pytz.timezone(tzname)
             
-            this_tz = timezones.get(hours, None)
-            if not this_tz:
-                timezones[hours] = tzname
-            elif tzname in popular_timezones:
-                # overwrite timezones with popular ones if equivalent
-                timezones[hours] = tzname
-        except:
-            logger.exception("Localization failure for timezone " + tzname)
-
-    return timezones
+            # in theory, this is more elegant, but tz.dst (timezone daylight savings - 0 if off 1 if on) is returning 0 for everything
+            #offset = tz.utcoffset(dt) - tz.dst(dt)
+            
+            # we do this try/except to avoid the possibility that pytz fails at localization
+            # see https://bugs.launchpad.net/pytz/+bug/207500
+            try:
+                offset = dt.replace(tzinfo=pytz.utc) - tz.localize(dt)
+                seconds = offset.days * 86400 + offset.seconds
+                minutes = seconds / 60
+                hours = minutes / 60
+                
+                # adjust for offsets that are greater than 12 hours (these are repeats of other offsets)
+                if hours > 12:
+                    hours = hours - 24
+                elif hours < -11:
+                    hours = hours + 24
+                
+                self.offsets[tzname] = hours
+                
+                this_tz = self.timezones.get(hours, None)
+                if not this_tz:
+                    self.timezones[hours] = tzname
+                elif tzname in popular_timezones:
+                    # overwrite timezones with popular ones if equivalent
+                    self.timezones[hours] = tzname
+            except:
+                logger.exception("Localization failure for timezone " + tzname)
+            
+            boundary = _next_transition(tz, dt)
+            if boundary and boundary < self.expires:
+                self.expires = boundary
+
+_timezone_index = None
+
+def get_timezone_index():
+    """
+    The current TimezoneIndex. Built once per process, and again only when it expires.
+    """
+    global _timezone_index
+    index = _timezone_index
+    now = datetime.utcnow()
+    if not index or now >= index.expires:
+        index = _timezone_index = TimezoneIndex(now)
+    return index
+
+def get_timezones():
+    """
+    {offset in hours: timezone name}, with the popular timezone for an offset where there is one.
+    """
+    # a copy, callers have been known to change it
+    return dict(get_timezone_index().timezones)
+
+def get_timezone_offset(tzname):
+    """
+    The offset in hours of a common timezone, as get_timezones figures it. None if it isnt one.
+    """
+    return get_timezone_index().offsets.get(tzname)
+
+def get_offset_timezone(hours):
+    """
+    The timezone get_timezones has for an offset, or None.
+    """
+    return get_timezone_index().timezones.get(hours)
 
 def relative_date_str(date, now=None, time=False): 
     '''
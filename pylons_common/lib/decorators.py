@@ -1,11 +1,16 @@
 from pylons_common.lib.exceptions import *
 
 from pylons_common.lib.date import convert_date
+from pylons_common.lib.timeline import get_timeline, timer
 
 from pylons_common.lib.log import create_logger
 logger = create_logger('pylons_common.lib.decorators')
 
-__all__ = ['zipargs', 'stackable', 'enforce']
+__all__ = ['zipargs', 'stackable', 'enforce', 'etag', 'cacheable', 'invalidates']
+
+# Attributes api functions carry for ApiMixin.dispatch. stackable copies them onto the
+# function a decorator returns so they survive decorator stacking.
+STACKED_ATTRIBUTES = ['etag', 'cache_options', 'invalidates']
 
 def zipargs(decorated_fn):
     """
@@ -47,6 +52,9 @@ def stackable(fn):
             # Do this in @auth due to decorator stacking.
             newfn.func_name = decorated_fn.func_name
             newfn.original_varnames = hasattr(decorated_fn, 'original_varnames') and decorated_fn.original_varnames or decorated_fn.func_code.co_varnames
+            for attr in STACKED_ATTRIBUTES:
+                if hasattr(decorated_fn, attr):
+                    setattr(newfn, attr, getattr(decorated_fn, attr))
         return newfn
     
     return new
@@ -55,6 +63,83 @@ def stackable(fn):
 ### Decorators for api functions
 ##
 
+# Process wide totals across every LookupCache. Not locked, so treat them as approximate.
+lookup_stats = {'hits': 0, 'misses': 0}
+
+class LookupCache(object):
+    """
+    Objects enforce has already resolved, keyed by (model class, field name, value).
+    One of these lives on each session, so it goes away when the session is removed at
+    the end of the request, and it is emptied after every commit and rollback. Objects that
+    were expunged or deleted from the session are treated as misses.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        obj = self.objects.get(key)
+        if obj is not None and (obj not in self.session or obj in self.session.deleted):
+            del self.objects[key]
+            obj = None
+        
+        if obj is None:
+            self.misses += 1
+            lookup_stats['misses'] += 1
+        else:
+            self.hits += 1
+            lookup_stats['hits'] += 1
+        return obj
+    
+    def set(self, key, obj):
+        # dont cache misses; the object might be created later in the request.
+        if obj is not None:
+            self.objects[key] = obj
+    
+    def clear(self):
+        self.objects.clear()
+
+def get_lookup_cache(Session):
+    """
+    Returns the LookupCache for the current session. Session can be a scoped_session or
+    a plain session.
+    """
+    session = Session
+    if hasattr(Session, 'registry'):
+        session = Session()
+    cache = getattr(session, '_lookup_cache', None)
+    if cache is None:
+        cache = session._lookup_cache = LookupCache(session)
+        session.extensions.append(get_lookup_cache_extension())
+    return cache
+
+_lookup_cache_extension = None
+
+def get_lookup_cache_extension():
+    """
+    The SessionExtension that empties a session's LookupCache when its transaction ends.
+    After a rollback the objects may not exist anymore, and after a commit other requests
+    can change them. One instance does for every session.
+    """
+    global _lookup_cache_extension
+    if _lookup_cache_extension is None:
+        from sqlalchemy.orm.interfaces import SessionExtension
+        
+        class LookupCacheExtension(SessionExtension):
+            def after_commit(self, session):
+                session._lookup_cache.clear()
+            
+            after_rollback = after_commit
+        
+        _lookup_cache_extension = LookupCacheExtension()
+    return _lookup_cache_extension
+
+# Max number of values bound into a single IN clause when enforce resolves a list of objects.
+# Sqlite chokes on more than 999 bound parameters.
+MAX_IN_VALUES = 500
+
 def enforce(Session, **types):
     """
     Assumes all arguments are unicode strings, and converts or resolves them to more complex objects.
@@ -70,8 +155,10 @@ def enforce(Session, **types):
         @zipargs(fn)
         def new(**kwargs):
             from sqlalchemy.ext import declarative
-
+            
+            start = timer()
             errors = []
+            cache = get_lookup_cache(Session)
             
             def convert(arg_name, arg_type, arg_value):
                 converted_value = arg_value
@@ -107,15 +194,21 @@ def enforce(Session, **types):
                                 is_int = False
                             
                             if not is_int and hasattr(arg_type, 'eid'):
-                                field = arg_type.eid
+                                field_name = 'eid'
                                 if arg_value is str:
                                     arg_value = arg_value.decode('utf-8')
                                 else:
                                     arg_value = unicode(arg_value)
                             else:
-                                field = arg_type.id
+                                field_name = 'id'
                                 arg_value = int(arg_value)
-                            converted_value = Session.query(arg_type).filter(field == arg_value).first() 
+                            
+                            key = (arg_type, field_name, arg_value)
+                            converted_value = cache.get(key)
+                            if converted_value is None:
+                                field = getattr(arg_type, field_name)
+                                converted_value = Session.query(arg_type).filter(field == arg_value).first()
+                                cache.set(key, converted_value)
                     elif arg_type is str:
                         if type(arg_value) is unicode:
                             converted_value = arg_value.encode('utf-8')
@@ -140,6 +233,56 @@ def enforce(Session, **types):
                 
                 return converted_value
 
+            def convert_models(arg_name, arg_type, arg_values):
+                """
+                Resolves a list of ids/eids to objects with one IN query per field rather
+                than a query per value. Order is preserved; values that dont resolve are errors.
+                """
+                values = {'id': [], 'eid': []}
+                keys = []
+                for arg_value in arg_values:
+                    try:
+                        key = ('id', int(arg_value))
+                    except ValueError, e:
+                        if not hasattr(arg_type, 'eid'):
+                            errors.append((e, arg_name, arg_value))
+                            continue
+                        if isinstance(arg_value, str):
+                            arg_value = arg_value.decode('utf-8')
+                        key = ('eid', unicode(arg_value))
+                    
+                    values[key[0]].append(key[1])
+                    keys.append((key, arg_value))
+                
+                found = {}
+                for field_name, field_values in values.iteritems():
+                    missing = []
+                    for value in set(field_values):
+                        obj = cache.get((arg_type, field_name, value))
+                        if obj is None:
+                            missing.append(value)
+                        else:
+                            found[(field_name, value)] = obj
+                    if not missing:
+                        continue
+                    
+                    field = getattr(arg_type, field_name)
+                    for i in range(0, len(missing), MAX_IN_VALUES):
+                        chunk = missing[i:i + MAX_IN_VALUES]
+                        for obj in Session.query(arg_type).filter(field.in_(chunk)).all():
+                            value = getattr(obj, field_name)
+                            found[(field_name, value)] = obj
+                            cache.set((arg_type, field_name, value), obj)
+                
+                converted_values = []
+                for key, arg_value in keys:
+                    obj = found.get(key)
+                    if obj is None:
+                        errors.append((ValueError('%s not found' % arg_type.__name__), arg_name, arg_value))
+                    else:
+                        converted_values.append(obj)
+                return converted_values
+            
             for name, value in kwargs.iteritems():
                 if name in types and value is not None:             
                     t = types[name]
@@ -150,19 +293,77 @@ def enforce(Session, **types):
                     elif isinstance(t, list):
                         if not isinstance(value, list):
                             list_of_values = [s for s in value.split(',') if s]
-                            converted_values = []
                             t = t[0]
-                            for v in list_of_values:
-                                converted_values.append(convert(name, t, v))
+                            if type(t) is declarative.DeclarativeMeta:
+                                converted_values = convert_models(name, t, list_of_values)
+                            else:
+                                converted_values = []
+                                for v in list_of_values:
+                                    converted_values.append(convert(name, t, v))
                         # If the value was already a list, then it must have
                         # been a list of DB objects, so we didn't need to touch it                       
                         kwargs[name] = converted_values
                     else:
                         kwargs[name] = convert(name, t, value)
+            
+            timeline = get_timeline()
+            if timeline:
+                timeline.mark('enforce', start)
+            
             if errors:
-                raise ApiValueException([{'value': str(e[2]), 'message':str(e[0]), 'field': e[1]} for e in errors], INVALID)
+                raise ApiValueException([{'value': unicode(e[2]), 'message':str(e[0]), 'field': e[1]} for e in errors], INVALID)
             else:
                 return fn(**kwargs)
             
         return new
-    return decorator
\ No newline at end of file
+    return decorator
+
+def etag(etag_fn):
+    """
+    Gives an api function a version hint for conditional GETs. etag_fn is called with the same
+    (unconverted) args as the function, before it is, and returns something that changes whenever
+    the function's result would, like a last modified date. If it matches the client's
+    If-None-Match, ApiMixin.dispatch sends a 304 without calling the function.
+    
+    @etag(lambda campaign, **kw: Campaign.get_modified_date(campaign))
+    @enforce(Session, campaign=Campaign)
+    def get(campaign):
+        ...
+    """
+    def decorator(fn):
+        fn.etag = etag_fn
+        return fn
+    return decorator
+
+def cacheable(ttl=60, tags=None, per_user=True):
+    """
+    Marks an api function's results as cacheable by ApiMixin.dispatch (when it has a
+    response_cache) for ttl seconds. The key is the version, module, function and params, plus
+    the user's id if per_user. tags are formatted with the function's raw args, so
+    'campaign:%(campaign)s' tags the entry with the requested campaign's id. A tag whose arg
+    is missing is left off. Calls to an @invalidates function with the same tag clear it.
+    
+    @cacheable(ttl=300, tags=['campaign:%(campaign)s'])
+    @enforce(Session, campaign=Campaign)
+    def get(campaign):
+        ...
+    """
+    def decorator(fn):
+        fn.cache_options = {'ttl': ttl, 'tags': tags or [], 'per_user': per_user}
+        return fn
+    return decorator
+
+def invalidates(*tags):
+    """
+    After this api function runs successfully through ApiMixin.dispatch, anything cached with
+    any of tags is invalidated. tags are formatted like @cacheable's.
+    
+    @invalidates('campaign:%(campaign)s')
+    @enforce(Session, campaign=Campaign)
+    def edit(campaign, name=None):
+        ...
+    """
+    def decorator(fn):
+        fn.invalidates = tags
+        return fn
+    return decorator
@@ -45,6 +45,12 @@ class CompoundException(AppException):
     def __str__(self):
         return '%s: %s (%s) (%s)' % (self.__repr__(), self.msg, self.code, [str(e) for e in self.exceptions])
 
+class NPlusOneException(AppException):
+    """
+    Raised by TimerProxy in strict mode when one query runs too many times in a request.
+    """
+    pass
+
 class ApiPrologueException(Exception):
     def __init__(self, http_response_code, msg, error_code=None):
         self.http_response_code = http_response_code
@@ -1,5 +1,6 @@
 import logging
 import inspect
+import sys
 import pylons
 import os
 
@@ -18,44 +19,77 @@ then to log, call:
 
 logger = None
 
-def log(log_obj, level, message, **kwargs):
-    """
-    Log to logger.info with a special context prefix that includes:
-    - First 10 characters of the session id, if available (else '-' * 10)
-    - Caller class name, if the caller was a class method, or the last atom of the module name.
-    - The function/method name of the caller
+# Class/function part of the prefix, cached per code object. See _context().
+_contexts = {}
 
-    :param message: Message to send to the logs, after context prefix
+LEVELS = {
+    'info': logging.INFO,
+    'warn': logging.WARNING,
+    'warning': logging.WARNING,
+    'error': logging.ERROR
+}
+
+def _defining_class(klass, code):
+    """
+    Finds the class in klass's mro that actually defines the function for code. Falls back on
+    klass (the function might be decorated).
+    """
+    for k in inspect.getmro(klass):
+        fn = k.__dict__.get(code.co_name)
+        fn = getattr(fn, '__func__', fn)
+        if getattr(fn, 'func_code', None) is code:
+            return k
+    return klass
+
+def _context(frame):
     """
-    frame = inspect.currentframe().f_back.f_back
-    fn_name = frame.f_code.co_name
+    Returns 'ClassName.function_name' (or 'module.function_name') for the frame. This is computed
+    once for each code object, so the frame's locals are only looked at the first time.
+    """
+    code = frame.f_code
+    context = _contexts.get(code)
+    if context:
+        return context
+    
     # Any variable called 'self' in the local scope of the frame is probably an instance
     instance = frame.f_locals.get('self')
-    class_name = instance and hasattr(instance, '__class__') and instance.__class__.__name__
+    klass = instance is not None and hasattr(instance, '__class__') and instance.__class__
     # If we can't find a suitable 'self' var, this might be a static classmethod, in which case
     # the first arg would be a reference to the class definition.
-    if not class_name:
-        first_arg_name = frame.f_code.co_varnames and frame.f_code.co_varnames[0] or ''
+    if not klass:
+        first_arg_name = code.co_varnames and code.co_varnames[0] or ''
         first_arg = frame.f_locals.get(first_arg_name)
         if first_arg and inspect.isclass(first_arg):
-            class_name = first_arg.__name__
-    # If we can't resolve a class at all (either instantiated or static), use the module name.
-    if not class_name:
-        module = frame.f_globals['__name__']
-        module = module.rsplit('.')[-1]
+            klass = first_arg
+    
+    if klass:
+        name = _defining_class(klass, code).__name__
+    else:
+        # If we can't resolve a class at all (either instantiated or static), use the module name.
+        name = frame.f_globals['__name__'].rsplit('.')[-1]
+    
+    context = _contexts[code] = '%s.%s' % (name, code.co_name)
+    return context
+
+def log(log_obj, level, message, **kwargs):
+    """
+    Log to logger.info with a special context prefix that includes:
+    - First 10 characters of the session id, if available (else '-' * 10)
+    - Class name that defines the caller, if the caller was a class method, or the last atom
+      of the module name.
+    - The function/method name of the caller
+
+    :param message: Message to send to the logs, after context prefix
+    """
+    frame = sys._getframe(2)
+    context = _context(frame)
+    del frame
 
     # Get the first 10 characters of the pylons session ID, if available.
     sid = hasattr(pylons.session, 'id') and pylons.session.id or '-' * 32
     sid = sid[0:10]
 
-    prefix = '%s %s.%s: ' % (sid, class_name or module, fn_name)
-
-    ## Alternate context prefix
-    #filename = frame.f_code.co_filename
-    #filename = '/'.join(filename.split(os.sep)[-3:])
-    #prefix = '%s %04d %s: ' % (sid, line_number, filename)
-
-    del frame
+    prefix = '%s %s: ' % (sid, context)
 
     if isinstance(message, unicode):
         message = message.encode('utf-8')
@@ -75,7 +109,12 @@ def create_logger(name):
     l = logging.getLogger(name)
 
     def log_level(log_obj, level):
-        return lambda message, **kwargs: log(log_obj, level, message, **kwargs)
+        levelno = LEVELS[level]
+        # Check the level before log() so disabled calls skip the frame inspection entirely.
+        def log_fn(message, **kwargs):
+            if log_obj.isEnabledFor(levelno):
+                return log(log_obj, level, message, **kwargs)
+        return log_fn
 
     # Replace each requested level method (ie logger.[level]()) with
     # our own prefix-adding function.  Requires some hairy closures.
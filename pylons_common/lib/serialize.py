@@ -0,0 +1,133 @@
+import datetime
+import decimal
+
+from pylons_common.lib.log import create_logger
+from pylons_common.lib.utils import dict_view, list_view
+logger = create_logger('pylons_common.lib.serialize')
+
+"""
+One place for json encoding. The fastest backend we can find is picked at import time:
+    
+    simplejson with its C speedups
+    stdlib json with its C speedups
+    simplejson, pure python
+    stdlib json, pure python
+
+Use it like simplejson:
+    
+    from pylons_common.lib import serialize
+    serialize.dumps({'a': 1})
+    serialize.dumps({'a': 1}, compact=True) # no whitespace
+
+Types json doesnt know about go through the functions in type_encoders. Register more with
+register_type(). Declarative sqlalchemy objects are encoded as a dict of their columns.
+"""
+
+__all__ = ['dumps', 'loads', 'get_encoder', 'register_type', 'backend_name']
+
+def _find_backends():
+    """
+    Returns a list of (name, module, is_accelerated) for every json lib that can be imported,
+    fastest first.
+    """
+    backends = []
+    
+    try:
+        import simplejson
+        from simplejson import encoder
+        backends.append(('simplejson', simplejson, bool(getattr(encoder, 'c_make_encoder', None))))
+    except ImportError:
+        pass
+    
+    try:
+        import json
+        from json import encoder
+        backends.append(('json', json, bool(getattr(encoder, 'c_make_encoder', None))))
+    except ImportError:
+        pass
+    
+    # stable sort keeps simplejson ahead of json when both (or neither) are accelerated
+    backends.sort(key=lambda b: not b[2])
+    return backends
+
+def _encode_date(value):
+    return value.strftime('%Y-%m-%d')
+
+def _encode_datetime(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+def _encode_view(value):
+    # whatever the view wraps, json already knows how to do it
+    return value._data
+
+type_encoders = {
+    datetime.datetime: _encode_datetime,
+    datetime.date: _encode_date,
+    decimal.Decimal: float,
+    dict_view: _encode_view,
+    list_view: _encode_view,
+}
+
+def register_type(klass, fn):
+    """
+    Encode objects of exactly type klass with fn(obj). fn should return something json knows about.
+    """
+    type_encoders[klass] = fn
+
+def _default(obj):
+    fn = type_encoders.get(type(obj))
+    if fn:
+        return fn(obj)
+    
+    table = getattr(obj.__class__, '__table__', None)
+    if table is not None:
+        return dict((column.key, getattr(obj, column.key, None)) for column in table.columns)
+    
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+backend_name, backend, accelerated = _find_backends()[0]
+
+_encoders = {
+    False: backend.JSONEncoder(default=_default),
+    True: backend.JSONEncoder(default=_default, separators=(',', ':')),
+}
+
+def get_encoder(compact=False):
+    """
+    The shared encoder instance. Use its iterencode() to encode incrementally.
+    """
+    return _encoders[compact]
+
+def dumps(obj, compact=False):
+    return _encoders[compact].encode(obj)
+
+def loads(s):
+    return backend.loads(s)
+
+def benchmark(payloads=None, number=1000):
+    """
+    Times dumps on each available backend and returns {backend name: seconds}. With no payloads
+    this uses something shaped like our usual api responses.
+    """
+    import timeit
+    
+    if payloads is None:
+        row = {u'eid': u'KZ5QGHSEHZHAPFG7FNWO6F', u'name': u'Some campaign', u'active': True,
+               u'budget': 1234.5, u'impressions': 123456, u'tags': [u'a', u'b', u'c'],
+               u'created_date': u'2010-06-01 12:00:00'}
+        payloads = [
+            {u'results': row},
+            {u'results': [row] * 100},
+            {u'errors': [{u'message': u'Not found', u'code': 16, u'field': u'campaign'}]},
+        ]
+    
+    times = {}
+    for name, module, is_accelerated in _find_backends():
+        for compact in (False, True):
+            separators = compact and (',', ':') or None
+            encoder = module.JSONEncoder(default=_default, separators=separators)
+            key = '%s%s%s' % (name, is_accelerated and ' (C)' or '', compact and ' compact' or '')
+            times[key] = timeit.Timer(lambda: [encoder.encode(p) for p in payloads]).timeit(number)
+            logger.info('%s: %.3fsec for %d runs' % (key, times[key], number))
+    
+    return times
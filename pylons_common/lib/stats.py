@@ -0,0 +1,88 @@
+import bisect
+import threading
+
+"""
+In-process histograms, mostly for timing api endpoints. Nothing is persisted; each process
+keeps its own numbers. Get them out with dump(), which returns plain dicts/lists you can
+jsonify from a controller.
+
+    from pylons_common.lib.stats import api_stats
+    api_stats.record('campaign.get', queries=3, db_ms=12.5, run_ms=40)
+    api_stats.dump()
+"""
+
+__all__ = ['Histogram', 'EndpointStats', 'api_stats']
+
+class Histogram(object):
+    """
+    Counts values into fixed buckets. Each bucket counts values <= its upper bound; the last
+    bucket catches everything bigger.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def dump(self):
+        bounds = list(self.buckets) + ['+Inf']
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': [[le, n] for le, n in zip(bounds, self.counts)]
+        }
+
+# Bucket upper bounds
+MS_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class EndpointStats(object):
+    """
+    Histograms of query count, db time and total run time for each endpoint name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+    
+    def record(self, endpoint, queries, db_ms, run_ms):
+        self.lock.acquire()
+        try:
+            stats = self.endpoints.get(endpoint)
+            if not stats:
+                stats = self.endpoints[endpoint] = {
+                    'queries': Histogram(COUNT_BUCKETS),
+                    'db_ms': Histogram(MS_BUCKETS),
+                    'run_ms': Histogram(MS_BUCKETS)
+                }
+            stats['queries'].add(queries)
+            stats['db_ms'].add(db_ms)
+            stats['run_ms'].add(run_ms)
+        finally:
+            self.lock.release()
+    
+    def dump(self):
+        self.lock.acquire()
+        try:
+            return dict((endpoint, dict((name, h.dump()) for name, h in stats.iteritems()))
+                        for endpoint, stats in self.endpoints.iteritems())
+        finally:
+            self.lock.release()
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.endpoints = {}
+        finally:
+            self.lock.release()
+
+# Filled in by ApiMixin.dispatch for sampled requests.
+api_stats = EndpointStats()
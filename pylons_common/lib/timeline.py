@@ -0,0 +1,73 @@
+import pylons
+from timeit import default_timer as timer
+
+"""
+Where did the time go in this request? A Timeline is a list of named spans, kept in the
+request environ. Code marks the end of a span with the time it started:
+
+    from pylons_common.lib.timeline import get_timeline, timer
+    timeline = get_timeline()
+    t = timer()
+    do_something()
+    t = timeline.mark('something', t)
+    do_something_else()
+    timeline.mark('something_else', t)
+
+The ajax decorator sends it as a Server-Timing header and puts it in the debug block.
+"""
+
+__all__ = ['Timeline', 'get_timeline', 'timer']
+
+ENVIRON_KEY = 'pylons_common.timeline'
+
+class Timeline(object):
+    def __init__(self):
+        # [(name, start, seconds)]
+        self.spans = []
+    
+    def mark(self, name, start, exclude=None):
+        """
+        Records a span from start until now and returns now, so calls can be chained. Time spent
+        in spans named in exclude that started after start is taken out, so a span doesn't
+        count time its nested spans already counted.
+        """
+        now = timer()
+        elapsed = now - start
+        if exclude:
+            elapsed -= sum(s for n, st, s in self.spans if n in exclude and st >= start)
+        self.spans.append((name, start, elapsed))
+        return now
+    
+    def totals(self):
+        """
+        [(name, ms)] with spans of the same name added up, in the order they first happened.
+        """
+        names = []
+        totals = {}
+        for name, start, elapsed in self.spans:
+            if name not in totals:
+                names.append(name)
+                totals[name] = 0
+            totals[name] += elapsed * 1000
+        return [(name, totals[name]) for name in names]
+    
+    def server_timing(self):
+        """
+        The value for a Server-Timing header.
+        """
+        return ', '.join('%s;dur=%.2f' % (name, ms) for name, ms in self.totals())
+
+def get_timeline(environ=None):
+    """
+    Returns the request's Timeline, creating it if need be. None outside of a request.
+    """
+    if environ is None:
+        try:
+            environ = pylons.request.environ
+        except TypeError:
+            return None
+    
+    timeline = environ.get(ENVIRON_KEY)
+    if timeline is None:
+        timeline = environ[ENVIRON_KEY] = Timeline()
+    return timeline
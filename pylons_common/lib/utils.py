@@ -1,4 +1,6 @@
 import base64
+import os
+import sys
 import uuid as uuid_mod
 from pylons_common.lib.log import create_logger
 logger = create_logger('pylons_common.lib.utils')
@@ -7,6 +9,199 @@ class forgiving_dict_accessor(dict):
     """
     Allow accessing a dictionary with dot-notation, returning None if the attribute doesn't exist.
     """
+    # the dict methods themselves, no python level call on every access
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+
+class dict_accessor(dict):
+    """
+    Allow accessing a dictionary content also using dot-notation.
+    """
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+def objectify(d, forgiving=False):
+    """
+    Return an object version of the dictionary passed in.
+    Works recursively.
+    """
+    if type(d) is dict:
+        if forgiving:
+            o = forgiving_dict_accessor()
+        else:
+            o = dict_accessor()
+        for key, value in d.iteritems():
+            if type(value) is dict or type(value) is list:
+                value = objectify(value)
+            o[type(key) is str and key or str(key)] = value
+        return o
+    elif type(d) is list:
+        l = []
+        for value in d:
+            if type(value) is dict or type(value) is list:
+                value = objectify(value)
+            l.append(value)
+        return l
+    else:
+        return d
+
+def _view(value):
+    if type(value) is dict:
+        return dict_view(value)
+    elif type(value) is list:
+        return list_view(value)
+    return value
+
+class dict_view(object):
+    """
+    objectify without the copy. Wraps d, and the dicts and lists in it are wrapped as they are
+    read, so a big payload you only look at part of costs next to nothing. Reads work like
+    objectify's dict_accessor (or forgiving_dict_accessor); writes go through to d. Keys are
+    not converted to str. Use to_dict() for a real objectified copy.
+    
+    payload = dict_view(simplejson.loads(body))
+    payload.campaign.name
+    """
+    __slots__ = ['_data', '_forgiving', '_views']
+    
+    def __init__(self, d, forgiving=False):
+        object.__setattr__(self, '_data', d)
+        object.__setattr__(self, '_forgiving', forgiving)
+        # key -> (value, its view), so reading the same key twice gives the same view
+        object.__setattr__(self, '_views', {})
+    
+    def __getitem__(self, key):
+        value = self._data[key]
+        if type(value) is not dict and type(value) is not list:
+            return value
+        
+        cached = self._views.get(key)
+        if cached and cached[0] is value:
+            return cached[1]
+        view = _view(value)
+        self._views[key] = (value, view)
+        return view
+    
+    def __getattr__(self, attr):
+        if self._forgiving and attr not in self._data:
+            return None
+        return self[attr]
+    
+    def __setitem__(self, key, value):
+        self._data[key] = value
+    
+    __setattr__ = __setitem__
+    
+    def __delitem__(self, key):
+        del self._data[key]
+    
+    def get(self, key, default=None):
+        if key in self._data:
+            return self[key]
+        return default
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    has_key = __contains__
+    
+    def __iter__(self):
+        return iter(self._data)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def keys(self):
+        return self._data.keys()
+    
+    iterkeys = __iter__
+    
+    def itervalues(self):
+        for key in self._data:
+            yield self[key]
+    
+    def iteritems(self):
+        for key in self._data:
+            yield key, self[key]
+    
+    def values(self):
+        return list(self.itervalues())
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def __eq__(self, other):
+        if isinstance(other, dict_view):
+            other = other._data
+        return self._data == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return 'dict_view(%r)' % (self._data,)
+    
+    def to_dict(self):
+        return objectify(self._data, self._forgiving)
+
+class list_view(object):
+    """
+    The list counterpart of dict_view. Slicing gives a plain list of views.
+    """
+    __slots__ = ['_data']
+    
+    def __init__(self, l):
+        self._data = l
+    
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return [_view(value) for value in self._data[index]]
+        return _view(self._data[index])
+    
+    def __setitem__(self, index, value):
+        self._data[index] = value
+    
+    def __iter__(self):
+        for value in self._data:
+            yield _view(value)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, value):
+        return value in self._data
+    
+    def __eq__(self, other):
+        if isinstance(other, list_view):
+            other = other._data
+        return self._data == other
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return 'list_view(%r)' % (self._data,)
+    
+    def to_list(self):
+        return objectify(self._data)
+
+def objectify_view(d, forgiving=False):
+    """
+    Like objectify, but returns a dict_view or list_view over d instead of copying it.
+    """
+    if type(d) is dict:
+        return dict_view(d, forgiving)
+    return _view(d)
+
+##
+## The objectify and accessors from before dict_view, kept for benchmark_objectify()
+##
+
+class original_forgiving_dict_accessor(dict):
     def __getattr__(self, attr):
         parent = super(self.__class__, self)
         if hasattr(parent, 'get') and callable(parent.get):
@@ -17,37 +212,111 @@ class forgiving_dict_accessor(dict):
     def __setattr__(self, attr, value):
         super(self.__class__, self).__setitem__(attr, value)
 
-class dict_accessor(dict):
-    """
-    Allow accessing a dictionary content also using dot-notation.
-    """
+class original_dict_accessor(dict):
     def __getattr__(self, attr):
-        return super(dict_accessor, self).__getitem__(attr)
+        return super(original_dict_accessor, self).__getitem__(attr)
 
     def __setattr__(self, attr, value):
-        super(dict_accessor, self).__setitem__(attr, value)
+        super(original_dict_accessor, self).__setitem__(attr, value)
 
-def objectify(d, forgiving=False):
-    """
-    Return an object version of the dictionary passed in.
-    Works recursively.
-    """
+def objectify_original(d, forgiving=False):
     if type(d) is dict:
         if forgiving:
-            o = forgiving_dict_accessor()
+            o = original_forgiving_dict_accessor()
         else:
-            o = dict_accessor()
+            o = original_dict_accessor()
         for key, value in d.iteritems():
-            o[str(key)] = objectify(value)
+            o[str(key)] = objectify_original(value)
         return o
     elif type(d) is list:
-        l = [] 
+        l = []
         for value in d:
-            l.append(objectify(value))
+            l.append(objectify_original(value))
         return l
     else:
         return d
 
+def _walk(o):
+    if isinstance(o, (dict, dict_view)):
+        for value in o.itervalues():
+            _walk(value)
+    elif isinstance(o, (list, list_view)):
+        for value in o:
+            _walk(value)
+
+def _walk_attributes(o):
+    # every value, read the way app code does: o.key
+    if isinstance(o, (dict, dict_view)):
+        for key in o.keys():
+            _walk_attributes(getattr(o, key))
+    elif isinstance(o, (list, list_view)):
+        for value in o:
+            _walk_attributes(value)
+
+def _footprint(o, shared):
+    """
+    Bytes in the containers (and views) reachable from o, not counting the ones in shared, a
+    set of ids. Scalars are shared with the payload so they dont count either.
+    """
+    if id(o) in shared:
+        return 0
+    shared.add(id(o))
+    
+    size = sys.getsizeof(o)
+    if isinstance(o, dict_view):
+        size += sys.getsizeof(o._views)
+        for pair in o._views.itervalues():
+            size += sys.getsizeof(pair) + _footprint(pair[1], shared)
+    elif isinstance(o, dict):
+        for value in o.itervalues():
+            size += _footprint(value, shared)
+    elif isinstance(o, list):
+        for value in o:
+            size += _footprint(value, shared)
+    return size
+
+def benchmark_objectify(payload=None, number=20):
+    """
+    Compares objectify_original, objectify and objectify_view on payload. With no payload this
+    uses 5000 records shaped like an api response. Returns {name: value}, with
+    
+        '<fn>, top level' and '<fn>, everything': seconds to make it and read just the top
+            level, or every value, number times
+        '<fn>, attribute reads': seconds to read every value with o.key on one already made,
+            number times
+        '<fn>, bytes': what it allocates on top of payload, once every value has been read
+    """
+    import timeit
+    
+    if payload is None:
+        payload = {'total': 5000, 'results': [{'id': i, 'name': u'item %d' % i, 'tags': ['a', 'b', 'c'],
+                   'owner': {'id': i, 'email': u'x@y.com', 'prefs': {'a': 1, 'b': 2}}} for i in range(5000)]}
+    
+    in_payload = set()
+    def collect(o):
+        if isinstance(o, (dict, list)):
+            in_payload.add(id(o))
+            for value in isinstance(o, dict) and o.itervalues() or o:
+                collect(value)
+    collect(payload)
+    
+    results = {}
+    for name, fn in [('objectify_original', objectify_original), ('objectify', objectify), ('objectify_view', objectify_view)]:
+        for read, use in [('top level', lambda o: o.keys()), ('everything', _walk)]:
+            key = '%s, %s' % (name, read)
+            results[key] = timeit.Timer(lambda: use(fn(payload))).timeit(number)
+            logger.info('%s: %.3fsec for %d runs' % (key, results[key], number))
+        
+        o = fn(payload)
+        key = '%s, attribute reads' % name
+        results[key] = timeit.Timer(lambda: _walk_attributes(o)).timeit(number)
+        logger.info('%s: %.3fsec for %d runs' % (key, results[key], number))
+        
+        key = '%s, bytes' % name
+        results[key] = _footprint(o, set(in_payload))
+        logger.info('%s: %d' % (key, results[key]))
+    return results
+
 def extract(d, *keys):
     """
     Creates a new dict that is a subset of d based on passed in keys.
@@ -70,6 +339,65 @@ def uuid():
     b = b[0:22] # lose the "==" that finishes a base64 value
     return b.decode('utf-8')
 
+# uuid4's version and variant bits, for a whole string of bytes at a time with str.translate
+_UUID_VERSION_BYTE = ''.join(chr(i & 0x0f | 0x40) for i in range(256))
+_UUID_VARIANT_BYTE = ''.join(chr(i & 0x3f | 0x80) for i in range(256))
+
+def uuids(n):
+    """
+    n uuid()s, with one os.urandom and one b32encode call for all of them.
+    """
+    # uuid() only keeps 22 chars, 110 bits, so the first 15 bytes of each uuid4 are plenty.
+    # 15 bytes is exactly 24 base32 chars, so they encode back to back without padding.
+    return _encode_uuids(os.urandom(15 * n))
+
+def _encode_uuids(random_bytes):
+    n = len(random_bytes) / 15
+    data = bytearray(random_bytes)
+    data[6::15] = str(data[6::15]).translate(_UUID_VERSION_BYTE)
+    data[8::15] = str(data[8::15]).translate(_UUID_VARIANT_BYTE)
+    
+    encoded = base64.b32encode(str(data)).decode('utf-8')
+    return [encoded[i:i+22] for i in xrange(0, 24 * n, 24)]
+
+def iter_uuids(batch_size=1000):
+    """
+    An endless stream of uuid()s, made batch_size at a time.
+    
+    eids = iter_uuids()
+    for row in rows:
+        row['eid'] = eids.next()
+    """
+    while True:
+        for u in uuids(batch_size):
+            yield u
+
+def check_uuids(n=10000):
+    """
+    Encodes n random uuid4s the way uuid() does and the way uuids() does, from the same random
+    bytes. Returns the ones that came out different, as [(expected, got)].
+    """
+    raw = [os.urandom(16) for i in xrange(n)]
+    expected = [base64.b32encode(uuid_mod.UUID(bytes=r, version=4).bytes)[0:22].decode('utf-8') for r in raw]
+    got = _encode_uuids(''.join(r[:15] for r in raw))
+    return [(e, g) for e, g in zip(expected, got) if e != g or type(e) is not type(g)]
+
+def benchmark_uuids(n=50000, number=3):
+    """
+    Times making n ids number times with uuid() in a loop, uuids(n) and iter_uuids().
+    Returns {name: seconds}.
+    """
+    import itertools
+    import timeit
+    
+    times = {}
+    for name, fn in [('uuid', lambda: [uuid() for i in xrange(n)]),
+                     ('uuids', lambda: uuids(n)),
+                     ('iter_uuids', lambda: list(itertools.islice(iter_uuids(), n)))]:
+        times[name] = timeit.Timer(fn).timeit(number)
+        logger.info('%s: %.3fsec for %d runs of %d ids' % (name, times[name], number, n))
+    return times
+
 def pluralize(num, if_many, if_one, if_zero=None):
     """
     returns the proper string based on the number passed.
@@ -1,19 +1,18 @@
-import pylons, sys
+import pylons, sys, os
 from weberror import errormiddleware, collector, reporter
 from weberror.evalexception import EvalException, get_debug_count, DebugInfo
 from weberror.errormiddleware import ErrorMiddleware, handle_exception
 from pylons.middleware import head_html, footer_html, media_path, report_libs
 from pylons.error import template_error_formatters
 from webob import Request, Response
-import simplejson as json
 import traceback
 
-import smtplib
+import atexit, smtplib, socket, threading, time, Queue
 from socket import sslerror #if desired
 
 from paste import fileapp, registry
 
-from pylons_common.lib import exceptions
+from pylons_common.lib import exceptions, serialize
 from pylons_common.lib.log import create_logger
 logger = create_logger('pylons_common.middleware.errors')
 
@@ -86,7 +85,7 @@ def handle_async_exception(exc_info, environ, debug_info=None):
             'trace': traceback.format_tb(trace)
         }
     
-    return json.dumps(result)
+    return serialize.dumps(result)
 
 class VanillaErrorMiddleware(ErrorMiddleware):
     def __call__(self, environ, start_response):
@@ -140,8 +139,133 @@ class VanillaErrorMiddleware(ErrorMiddleware):
                 # clean up locals...
                 exc_info = None
 
+class SpilledDebugInfo(object):
+    """
+    Stands in for a DebugInfo that was evicted from a DebugInfoStore. It can only show the
+    static error page that was written to disk; the interactive frames are gone.
+    """
+    def __init__(self, counter, filename):
+        self.counter = counter
+        self.filename = filename
+    
+    def content(self):
+        f = open(self.filename, 'rb')
+        try:
+            return [f.read()]
+        finally:
+            f.close()
+    
+    def wsgi_application(self, environ, start_response):
+        start_response('200 OK', [('content-type', 'text/html')])
+        return self.content()
+
+class DebugInfoStore(object):
+    """
+    A dict-like replacement for EvalException.debug_infos that holds at most capacity
+    DebugInfos, each for at most ttl seconds. The least recently used are evicted first.
+    Evicted DebugInfos have their references (exc_info, frames, environ) cleared so the memory
+    actually goes away.
+    
+    If spill_dir is set, the error page for an evicted DebugInfo is written there first and
+    /_debug/view/<n> keeps working off the file. Nothing cleans up spill_dir.
+    """
+    def __init__(self, capacity=100, ttl=3600, spill_dir=None):
+        import collections
+        self.capacity = capacity
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.infos = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def spill_filename(self, key):
+        return os.path.join(self.spill_dir, 'debug-%s.html' % key)
+    
+    def evict(self, key):
+        debug_info, created = self.infos.pop(key)
+        if self.spill_dir:
+            try:
+                content = ''.join(debug_info.content())
+                if isinstance(content, unicode):
+                    content = content.encode('utf8')
+                f = open(self.spill_filename(key), 'wb')
+                try:
+                    f.write(content)
+                finally:
+                    f.close()
+            except:
+                logger.exception('Could not spill debug info %s' % key)
+        debug_info.__dict__.clear()
+    
+    def expire(self):
+        """
+        Evicts expired entries, then the least recently used while over capacity. get() moves
+        what it reads to the end, so the front is the least recently used, not the oldest, and
+        expired entries can be anywhere. There are only capacity of them to look at.
+        """
+        cutoff = time.time() - self.ttl
+        for key, (debug_info, created) in self.infos.items():
+            if created < cutoff:
+                self.evict(key)
+        
+        while len(self.infos) > self.capacity:
+            self.evict(next(iter(self.infos)))
+    
+    def __setitem__(self, key, debug_info):
+        self.lock.acquire()
+        try:
+            self.infos.pop(key, None)
+            self.infos[key] = (debug_info, time.time())
+            self.expire()
+        finally:
+            self.lock.release()
+    
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            self.expire()
+            if key in self.infos:
+                # move to the end, it is the most recently used now
+                debug_info, created = entry = self.infos.pop(key)
+                self.infos[key] = entry
+                return debug_info
+        finally:
+            self.lock.release()
+        
+        if self.spill_dir and os.path.exists(self.spill_filename(key)):
+            return SpilledDebugInfo(key, self.spill_filename(key))
+        return default
+    
+    def __getitem__(self, key):
+        debug_info = self.get(key)
+        if debug_info is None:
+            raise KeyError(key)
+        return debug_info
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def __len__(self):
+        return len(self.infos)
+    
+    def keys(self):
+        return self.infos.keys()
+    
+    def values(self):
+        return [debug_info for debug_info, created in self.infos.values()]
+    
+    def items(self):
+        return [(key, debug_info) for key, (debug_info, created) in self.infos.items()]
+
 class DebugErrorMiddleware(EvalException):
     
+    def __init__(self, *args, **kwargs):
+        store = DebugInfoStore(
+            capacity=int(kwargs.pop('debug_info_capacity', None) or 100),
+            ttl=int(kwargs.pop('debug_info_ttl', None) or 3600),
+            spill_dir=kwargs.pop('debug_info_spill_dir', None))
+        super(DebugErrorMiddleware, self).__init__(*args, **kwargs)
+        self.debug_infos = store
+    
     def respond(self, environ, start_response):
         """
         This is straight copied from the original ErrorMiddleware code. Unfortunately they
@@ -167,56 +291,263 @@ class DebugErrorMiddleware(EvalException):
             __traceback_supplement__ = errormiddleware.Supplement, self, environ
             app_iter = self.application(environ, detect_start_response)
             
-            # Don't create a list from a paste.fileapp object 
+            # Don't wrap a paste.fileapp object 
             if isinstance(app_iter, fileapp._FileIter): 
                 return app_iter
             
-            try:
-                return_iter = list(app_iter)
-                return return_iter
-            finally:
-                if hasattr(app_iter, 'close'):
-                    app_iter.close()
+            return self.make_catching_iter(app_iter, environ, start_response, base_path)
         except:
-            exc_info = sys.exc_info()
-            
-            is_async = environ.get('is_async', None) == True
-            content_type = is_async and 'application/json' or 'text/html'
-            
-            # Tell the Registry to save its StackedObjectProxies current state
-            # for later restoration
-            registry.restorer.save_registry_state(environ)
+            return self.handle_exception(sys.exc_info(), environ, start_response, base_path,
+                                         headers_sent=bool(started))
+    
+    def make_catching_iter(self, app_iter, environ, start_response, base_path):
+        """
+        Streams app_iter through rather than buffering it. An exception raised while iterating
+        is turned into the debug page (or json) if nothing has been sent yet. Once output has
+        started, html responses get the debug page appended and async responses just reraise.
+        """
+        headers_sent = False
+        try:
+            try:
+                for chunk in app_iter:
+                    if chunk:
+                        headers_sent = True
+                    yield chunk
+            except:
+                exc_info = sys.exc_info()
+                if headers_sent and environ.get('is_async', None) == True:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for chunk in self.handle_exception(exc_info, environ, start_response, base_path,
+                                                   headers_sent=headers_sent):
+                    yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    
+    def handle_exception(self, exc_info, environ, start_response, base_path, headers_sent=False):
+        is_async = environ.get('is_async', None) == True
+        content_type = is_async and 'application/json' or 'text/html'
+        
+        # Tell the Registry to save its StackedObjectProxies current state
+        # for later restoration
+        registry.restorer.save_registry_state(environ)
 
-            count = get_debug_count(environ)
-            view_uri = self.make_view_url(environ, base_path, count)
-            if not started:
-                headers = [('content-type', content_type)]
-                headers.append(('X-Debug-URL', view_uri))
-                start_response('500 Internal Server Error',
-                               headers,
-                               exc_info)
-            
-            environ['wsgi.errors'].write('Debug at: %s\n' % view_uri)
+        count = get_debug_count(environ)
+        view_uri = self.make_view_url(environ, base_path, count)
+        if not headers_sent:
+            headers = [('content-type', content_type)]
+            headers.append(('X-Debug-URL', view_uri))
+            start_response('500 Internal Server Error',
+                           headers,
+                           exc_info)
+        
+        environ['wsgi.errors'].write('Debug at: %s\n' % view_uri)
 
-            exc_data = collector.collect_exception(*exc_info)
-            exc_data.view_url = view_uri
-            if self.reporters:
-                for reporter in self.reporters:
-                    reporter.report(exc_data)
-            
-            debug_info = DebugInfo(count, exc_info, exc_data, base_path,
-                                   environ, view_uri, self.error_template,
-                                   self.templating_formatters, self.head_html,
-                                   self.footer_html, self.libraries)
-            assert count not in self.debug_infos
-            self.debug_infos[count] = debug_info
+        exc_data = collector.collect_exception(*exc_info)
+        exc_data.view_url = view_uri
+        if self.reporters:
+            for reporter in self.reporters:
+                reporter.report(exc_data)
+        
+        debug_info = DebugInfo(count, exc_info, exc_data, base_path,
+                               environ, view_uri, self.error_template,
+                               self.templating_formatters, self.head_html,
+                               self.footer_html, self.libraries)
+        assert count not in self.debug_infos
+        self.debug_infos[count] = debug_info
 
-            if is_async:
-                return [handle_async_exception(exc_info, environ, debug_info=debug_info)]
-            
-            # @@: it would be nice to deal with bad content types here
-            return debug_info.content()
+        if is_async:
+            return [handle_async_exception(exc_info, environ, debug_info=debug_info)]
+        
+        # @@: it would be nice to deal with bad content types here
+        return debug_info.content()
+    
+class ComEmailReporter(reporter.EmailReporter):
+    """
+    Emails errors over one smtp connection that is kept open between reports, and
+    reconnects if the server has dropped it.
+    """
+    smtp_port = None
+    
+    def __init__(self, **conf):
+        reporter.EmailReporter.__init__(self, **conf)
+        self.server = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        logger.info('Connecting to smtp on %s:%s for %s, tls? %s' % (
+            self.smtp_server, self.smtp_port, self.smtp_username, self.smtp_use_tls)
+        )
+        if self.smtp_port:
+            server = smtplib.SMTP(self.smtp_server, int(self.smtp_port))
+        else:
+            server = smtplib.SMTP(self.smtp_server)
+        if self.smtp_use_tls:
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+        if self.smtp_username and self.smtp_password:
+            server.login(self.smtp_username, self.smtp_password)
+        return server
     
+    def disconnect(self):
+        server, self.server = self.server, None
+        if server:
+            try:
+                server.quit()
+            except (sslerror, smtplib.SMTPException, socket.error):
+                # sslerror is raised in tls connections on closing sometimes
+                pass
+    
+    def send(self, msg):
+        self.lock.acquire()
+        try:
+            # A kept open connection may have been timed out by the server. Try once more on
+            # a fresh connection.
+            for attempt in range(2):
+                if not self.server:
+                    self.server = self.connect()
+                try:
+                    ## FIXME: this should check the return value from this function:
+                    result = self.server.sendmail(self.from_address,
+                                    self.to_addresses, msg.as_string())
+                    logger.info('Result from sendmail %s' % result)
+                    return result
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    self.disconnect()
+                    if attempt:
+                        raise
+        finally:
+            self.lock.release()
+    
+    def report(self, exc_data, count=1):
+        logger.info('Emailed about error %s' % exc_data)
+        msg = self.assemble_email(exc_data)
+        if count > 1:
+            subject = msg['Subject']
+            del msg['Subject']
+            msg['Subject'] = '%s (x%d)' % (subject, count)
+        self.send(msg)
+
+class AsyncReporter(object):
+    """
+    Wraps a reporter so report() only puts the error on a bounded queue. A worker thread
+    drains the queue, waiting up to window seconds to collect a batch. Errors in a batch
+    with the same type, message and traceback are sent once with a count. If the queue is
+    full the error is dropped and counted in self.dropped rather than blocking the request.
+    """
+    queue_size = 100
+    window = 10.0
+    
+    def __init__(self, reporter, queue_size=None, window=None):
+        self.reporter = reporter
+        self.queue = Queue.Queue(queue_size or self.queue_size)
+        if window is not None:
+            self.window = window
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def report(self, exc_data):
+        self.start()
+        try:
+            self.queue.put_nowait(exc_data)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def start(self):
+        if self.thread:
+            return
+        self.lock.acquire()
+        try:
+            if not self.thread:
+                thread = threading.Thread(target=self.run, name='AsyncReporter')
+                thread.setDaemon(True)
+                thread.start()
+                self.thread = thread
+                # the thread is a daemon, so send whatever is queued on a normal shutdown
+                atexit.register(self.flush)
+        finally:
+            self.lock.release()
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.window
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            self.send_batch(batch)
+    
+    def flush(self):
+        """
+        Synchronously sends everything in the queue. Handy in tests.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        if batch:
+            self.send_batch(batch)
+    
+    def send_batch(self, batch):
+        if self.dropped:
+            logger.warning('Dropped %d error reports, the queue was full' % self.dropped)
+            self.dropped = 0
+        
+        counts = {}
+        unique = []
+        for exc_data in batch:
+            key = error_key(exc_data)
+            if key not in counts:
+                counts[key] = 0
+                unique.append((key, exc_data))
+            counts[key] += 1
+        
+        for key, exc_data in unique:
+            try:
+                self.reporter.report(exc_data, count=counts[key])
+            except:
+                logger.exception('Failed to report error %s' % exc_data)
+
+def error_key(exc_data):
+    """
+    Errors with the same key are considered duplicates.
+    """
+    return (exc_data.exception_type, str(exc_data.exception_value),
+            tuple((frame.filename, frame.lineno) for frame in exc_data.frames))
+
+# Where VariableErrorHandler leaves its reporters, for code that catches its own exceptions
+REPORTERS_ENVIRON_KEY = 'pylons_common.error_reporters'
+
+def report_exception(environ, exc_info=None):
+    """
+    Sends a caught exception (sys.exc_info() by default) to the reporters, the way the error
+    middleware does with the ones it sees. Does nothing outside a VariableErrorHandler.
+    """
+    reporters = environ.get(REPORTERS_ENVIRON_KEY)
+    if not reporters:
+        return
+    
+    exc_data = collector.collect_exception(*(exc_info or sys.exc_info()))
+    for r in reporters:
+        try:
+            r.report(exc_data)
+        except:
+            logger.exception('Failed to report error %s' % exc_data)
+
+# errorware settings that only we read. VanillaErrorMiddleware gets the rest as keyword args
+# and doesnt take any it doesnt know about.
+LOCAL_ERRORWARE_KEYS = ['smtp_port', 'error_email_async', 'error_email_queue_size', 'error_email_window',
+                        'debug_info_capacity', 'debug_info_ttl', 'debug_info_spill_dir']
+
 class VariableErrorHandler(object):
     """
     This handler is basically a copy of pylons.middleware.ErrorHandler, but with a runtime
@@ -252,7 +583,7 @@ class VariableErrorHandler(object):
         # confusing part is that ErrorMiddleware uses DIFFERENT keys for these email addresses
         # than the pylons.config module! F. Bottom line: ignore the __init__ in ErrorMiddleware.
         # All our error config happens in pylons.config and is passed in via errorware.
-        reporters = self.get_reporters(errorware)
+        reporters = self.reporters = self.get_reporters(errorware)
         
         # This should suppress the auto email in VanillaErrorMiddleware
         # We need to do this so cause we have our own in reporters above.
@@ -266,9 +597,12 @@ class VariableErrorHandler(object):
                             templating_formatters=template_error_formatters,
                             media_paths=py_media, head_html=head_html, 
                             footer_html=footer,
-                            libraries=report_libs, reporters=reporters)
+                            libraries=report_libs, reporters=reporters,
+                            debug_info_capacity=errorware.get('debug_info_capacity'),
+                            debug_info_ttl=errorware.get('debug_info_ttl'),
+                            debug_info_spill_dir=errorware.get('debug_info_spill_dir'))
         
-        d = dict([(k, v) for k, v in errorware.items() if k != 'smtp_port'])
+        d = dict([(k, v) for k, v in errorware.items() if k not in LOCAL_ERRORWARE_KEYS])
         self.glossy_error_app = VanillaErrorMiddleware(app, global_conf, reporters=reporters, **d)
     
     def get_reporters(self, errorware):
@@ -292,44 +626,25 @@ class VariableErrorHandler(object):
         
         logger.info('ErrorWare %s' % errorware)
         
-        class ComEmailReporter(reporter.EmailReporter):
-            #TODO: using smtp_port from outside. Ghetto.
-            def report(self, exc_data):
-                logger.info('Sending email on %s:%s for %s, tls? %s' % (
-                    self.smtp_server, smtp_port, self.smtp_username, self.smtp_use_tls)
-                )
-                logger.info('Emailed about error %s' % exc_data)
-                msg = self.assemble_email(exc_data)
-                if smtp_port:
-                    server = smtplib.SMTP(self.smtp_server, int(smtp_port))
-                else:
-                    server = smtplib.SMTP(self.smtp_server)
-                if self.smtp_use_tls:
-                    server.ehlo()
-                    server.starttls()
-                    server.ehlo()
-                if self.smtp_username and self.smtp_password:
-                    server.login(self.smtp_username, self.smtp_password)
-                ## FIXME: this should check the return value from this function:
-                result = server.sendmail(self.from_address,
-                                self.to_addresses, msg.as_string())
-                logger.info('Result from sendmail %s' % result)
-                try:
-                    server.quit()
-                except sslerror:
-                    # sslerror is raised in tls connections on closing sometimes
-                    pass
-        
         # emails will not be sent in dev. 
         if error_email:
-            return [ComEmailReporter(
+            email_reporter = ComEmailReporter(
                 to_addresses=error_email,
                 from_address=from_address,
                 smtp_server=smtp_server,
+                smtp_port=smtp_port,
                 smtp_username=smtp_username,
                 smtp_password=smtp_password,
                 smtp_use_tls=smtp_use_tls,
-                subject_prefix=subject_prefix)]
+                subject_prefix=subject_prefix)
+            
+            # By default mail goes out on a background thread so a request never waits on smtp.
+            if not converters.asbool(errorware.get('error_email_async', True)):
+                return [email_reporter]
+            
+            return [AsyncReporter(email_reporter,
+                        queue_size=int(errorware.get('error_email_queue_size', AsyncReporter.queue_size)),
+                        window=float(errorware.get('error_email_window', AsyncReporter.window)))]
         
         return []
     
@@ -341,6 +656,8 @@ class VariableErrorHandler(object):
         chooses which piece of middleware gets this request next, and it's up
         to that middleware to try/except and handle errors if they occur.
         """
+        environ[REPORTERS_ENVIRON_KEY] = self.reporters
+        
         session = environ.get('beaker.session')
         show_debug = bool(session and session.get('show_debug') or False)
         
@@ -1,12 +1,137 @@
 import pylons
+import math
+import os
+import re
+import threading
 import time
+import traceback
+from timeit import default_timer as timer
 from sqlalchemy.interfaces import ConnectionProxy
 
+from pylons_common.lib.exceptions import NPlusOneException
+from pylons_common.lib.log import create_logger
+logger = create_logger('pylons_common.sqlalchemy.proxy')
+
 class _fake_context(object):
     pass
+
+class QueryRecord(object):
+    """
+    One execute. Only the statement template, a reference to the parameters and the time are
+    kept; the interpolated sql is rendered by sql() when the debug payload is built.
+    """
+    __slots__ = ['statement', 'parameters', 'executemany', 'time']
+    
+    def __init__(self, statement, parameters, executemany, time):
+        self.statement = statement
+        self.parameters = parameters
+        self.executemany = executemany
+        self.time = time
+    
+    def sql(self):
+        statement = decode(self.statement)
+        if self.executemany:
+            rows = self.parameters or []
+            if not rows:
+                return statement
+            return u'%s -- x%d rows' % (interpolate(statement, rows[0]), len(rows))
+        return interpolate(statement, self.parameters)
+    
+    @property
+    def fingerprint(self):
+        return fingerprint(self.statement)
+    
+    # c.queries used to be [sql, time] lists, and templates still do "for q, t in c.queries"
+    def __iter__(self):
+        return iter((self.sql(), self.time))
+    
+    def __getitem__(self, index):
+        return (self.sql(), self.time)[index]
+    
+    def __len__(self):
+        return 2
+
 class TimerProxy(ConnectionProxy):
-    def __init__(self, *args, **kw):
+    """
+    Times queries for the debug block (when c.show_debug is set) and for sampled api calls.
+    
+    With n_plus_one_threshold set, statements are also fingerprinted per request and any
+    fingerprint run more than that many times is logged and reported in the ajax debug block,
+    along with where it was first run from. n_plus_one_strict raises NPlusOneException instead,
+    which is what you want in tests.
+    
+    With slow_query_threshold (ms) set, any statement that takes longer is logged with its
+    fingerprint, parameters, the request path and the api function being dispatched. With
+    slow_query_explain, the plan is captured on the same connection afterwards and logged too.
+    Each fingerprint is logged at most once every slow_query_interval seconds.
+    """
+    def __init__(self, n_plus_one_threshold=None, n_plus_one_strict=False,
+                 slow_query_threshold=None, slow_query_explain=False, slow_query_interval=60,
+                 *args, **kw):
         super(TimerProxy, self).__init__(*args, **kw)
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.n_plus_one_strict = n_plus_one_strict
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_explain = slow_query_explain
+        self.slow_query_interval = slow_query_interval
+        # fingerprint -> [last logged time, number suppressed since]
+        self.slow_queries_logged = {}
+    
+    def log_slow_query(self, cursor, statement, parameters, context, executemany, elapsed):
+        fp = fingerprint(statement)
+        now = time.time()
+        logged = self.slow_queries_logged.get(fp)
+        if logged and now - logged[0] < self.slow_query_interval:
+            logged[1] += 1
+            return
+        
+        if len(self.slow_queries_logged) >= MAX_FINGERPRINTS:
+            self.slow_queries_logged.clear()
+        suppressed = logged and logged[1] or 0
+        self.slow_queries_logged[fp] = [now, 0]
+        
+        try:
+            path = pylons.request.path_info
+        except TypeError:
+            path = None
+        
+        message = ['Slow query (%.1fms) in %s for %s: %s' % (elapsed * 1000, getattr(_local, 'api_function', None), path, fp),
+                   'Parameters: %r' % (parameters,)]
+        if suppressed:
+            message.append('%d more since last logged' % suppressed)
+        if self.slow_query_explain and not executemany:
+            plan = explain(cursor, statement, parameters, context)
+            if plan:
+                message.append('Plan:\n%s' % '\n'.join(' | '.join(unicode(col) for col in row) for row in plan))
+        
+        logger.warning('\n'.join(message))
+    
+    def check_n_plus_one(self, c, statement):
+        """
+        Counts the statement's fingerprint for this request. Flags it when the count passes
+        the threshold.
+        """
+        # not things the base controller sets up, and tmpl_context raises on missing attributes
+        counts = getattr(c, 'query_fingerprints', None)
+        if not counts:
+            counts = c.query_fingerprints = {}
+        
+        fp = fingerprint(statement)
+        entry = counts.get(fp)
+        if entry is None:
+            # the stack of the first occurrence; only trimmed and formatted if it gets flagged
+            entry = counts[fp] = [0, traceback.extract_stack()]
+        entry[0] += 1
+        
+        if entry[0] == self.n_plus_one_threshold + 1:
+            if not getattr(c, 'n_plus_one', None):
+                c.n_plus_one = []
+            c.n_plus_one.append(fp)
+            
+            message = 'Possible N+1: query run more than %d times: %s' % (self.n_plus_one_threshold, fp)
+            logger.warning('%s\nFirst run from:\n%s' % (message, ''.join(traceback.format_list(call_site(entry[1])))))
+            if self.n_plus_one_strict:
+                raise NPlusOneException(message)
     
     def cursor_execute(self, execute, cursor, statement, parameters, context, executemany):
         
@@ -21,49 +146,163 @@ class TimerProxy(ConnectionProxy):
             show_debug = False
             c.queries = None
             c.query_time = ''
-
-        if not show_debug:
+        
+        sample = getattr(_local, 'sample', None)
+        detect = self.n_plus_one_threshold and not isinstance(c, _fake_context)
+        
+        if not (show_debug or sample or detect or self.slow_query_threshold is not None):
             return super(TimerProxy, self).cursor_execute(execute, cursor, statement, parameters, context, executemany)
-
-        now = time.time()
+        
+        if detect:
+            self.check_n_plus_one(c, statement)
+        
+        if show_debug and not c.queries:
+            c.queries = []
+        
+        start = timer()
         try:
-            if not c.queries:
-                c.queries = []
-
-            q_params = parameters
-            if not executemany:
-                q_params = [parameters]
-
-            def decode_params(d):
-                for key in d:
-                    val = d[key]
-                    if isinstance(val, str):
-                        d[key] = val.decode('utf-8', 'replace')
-                return d
-
-            for params in q_params:
-                if params is not None:
-                    quoted_params = dict((param, quote(val)) for param, val in params.iteritems())
-                    st = [statement.decode('utf-8', 'replace') % decode_params(quoted_params), 0]
-                else:
-                    st = [statement.decode('utf-8', 'replace'), 0]
-                c.queries.append(st)
-
             r = execute(cursor, statement, parameters, context)
-        except Exception, e:
-           raise e
+        finally:
+            elapsed = timer() - start
+            
+            if sample:
+                sample.queries += 1
+                sample.time += elapsed
+            
+            if show_debug:
+                c.queries.append(QueryRecord(statement, parameters, executemany, elapsed))
+                if c.query_time == '':
+                    c.query_time = 0
+                c.query_time += elapsed
         
-        else:
-            if c.query_time == '':
-                c.query_time = 0
-            c.query_time += time.time() - now
-        
-            partial_time = (time.time() - now)/len(q_params)
-            for i in range(len(q_params)):
-                c.queries[-(i+1)][1] = partial_time
+        if self.slow_query_threshold is not None and elapsed * 1000 >= self.slow_query_threshold:
+            self.log_slow_query(cursor, statement, parameters, context, executemany, elapsed)
         
         return r
 
+##
+## Slow queries
+##
+
+# How to ask each database for a plan
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgres': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+def explain(cursor, statement, parameters, context):
+    """
+    Returns the plan rows for a SELECT, run on a fresh cursor on the same connection so the
+    original result set is left alone. None if it can't be done.
+    """
+    dialect = getattr(getattr(context, 'dialect', None), 'name', None)
+    prefix = EXPLAIN_PREFIXES.get(dialect)
+    connection = getattr(cursor, 'connection', None)
+    if not (prefix and connection) or not statement.lstrip()[:6].upper() == 'SELECT':
+        return None
+    
+    explain_cursor = connection.cursor()
+    try:
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            return explain_cursor.fetchall()
+        except Exception, e:
+            logger.warning('Could not explain query: %s' % e)
+            return None
+    finally:
+        explain_cursor.close()
+
+def set_api_function(api_function):
+    """
+    ApiMixin.dispatch tells us what it's running so slow queries can say where they came from.
+    """
+    _local.api_function = api_function
+
+##
+## N+1 detection
+##
+
+def call_site(stack):
+    """
+    Drops the sqlalchemy (and this module's) frames off the end of an extracted stack, so it
+    ends where the app code called into the db.
+    """
+    skip = os.sep + 'sqlalchemy' + os.sep
+    end = len(stack)
+    while end and skip in stack[end - 1][0]:
+        end -= 1
+    return stack[:end] or stack
+
+def n_plus_one_report(c):
+    """
+    The flagged fingerprints for this request, as dicts for the debug block.
+    """
+    report = []
+    for fp in getattr(c, 'n_plus_one', None) or []:
+        count, stack = c.query_fingerprints[fp]
+        report.append({
+            'fingerprint': decode(fp),
+            'count': count,
+            'stack': traceback.format_list(call_site(stack))
+        })
+    return report
+
+##
+## Sampling. Cheap per-thread counters that work without show_debug.
+##
+
+_local = threading.local()
+
+class QuerySample(object):
+    __slots__ = ['queries', 'time']
+    
+    def __init__(self):
+        self.queries = 0
+        self.time = 0.0
+
+def start_sample():
+    """
+    Starts counting queries and db time on this thread.
+    """
+    _local.sample = QuerySample()
+    return _local.sample
+
+def end_sample():
+    """
+    Stops counting on this thread and returns the QuerySample, or None if there wasnt one.
+    """
+    sample = getattr(_local, 'sample', None)
+    _local.sample = None
+    return sample
+
+##
+## Rendering and aggregation. None of this runs while the query does.
+##
+
+def interpolate(statement, params):
+    """
+    statement with params quoted into it. Good enough for reading, not for running.
+    """
+    if params is None:
+        return statement
+    
+    try:
+        if isinstance(params, dict):
+            quoted = dict((key, decode(quote(val))) for key, val in params.iteritems())
+        else:
+            quoted = tuple(decode(quote(val)) for val in params)
+        return statement % quoted
+    except (TypeError, ValueError, KeyError):
+        # paramstyles like qmark or named dont work with %
+        return u'%s -- %r' % (statement, params)
+
+def decode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
 def quote(p):
     return quoters.get(type(p), defaultq)(p)
 
@@ -78,4 +317,65 @@ quoters = {
 }
 
 def defaultq(p):
-    return u"'%s'" % (unicode(p))
\ No newline at end of file
+    return u"'%s'" % (unicode(p))
+
+# (regex, replacement) applied in order to make a fingerprint
+FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                  # string literals
+    (re.compile(r'%\(\w+\)s|:\w+|%s|\?'), '?'),             # bind params, any paramstyle
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),                # number literals
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),    # IN lists of any length
+    (re.compile(r'\s+'), ' '),
+]
+
+MAX_FINGERPRINTS = 5000
+_fingerprints = {}
+
+def fingerprint(statement):
+    """
+    Normalizes a statement so the same query with different values (or a different number of
+    IN values) gets the same string. Cached per statement.
+    """
+    fp = _fingerprints.get(statement)
+    if fp is None:
+        fp = statement
+        for regex, replacement in FINGERPRINT_RULES:
+            fp = regex.sub(replacement, fp)
+        fp = fp.strip()
+        
+        if len(_fingerprints) >= MAX_FINGERPRINTS:
+            _fingerprints.clear()
+        _fingerprints[statement] = fp
+    return fp
+
+def percentile(sorted_values, pct):
+    """
+    Nearest rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0
+    index = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+def summarize_queries(queries):
+    """
+    Aggregates QueryRecords by fingerprint. Returns a list of dicts, most total time first.
+    """
+    groups = {}
+    for q in queries:
+        groups.setdefault(q.fingerprint, []).append(q.time)
+    
+    summary = []
+    for fp, times in groups.iteritems():
+        times.sort()
+        summary.append({
+            'fingerprint': decode(fp),
+            'count': len(times),
+            'total': sum(times),
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'max': times[-1]
+        })
+    
+    summary.sort(key=lambda s: -s['total'])
+    return summary
@@ -0,0 +1,288 @@
+import hashlib
+import HTMLParser
+from formencode import htmlfill
+
+from pylons_common.lib.cache import LRUCache
+from pylons_common.lib.log import create_logger
+logger = create_logger('pylons_common.web.formfill')
+
+"""
+htmlfill.render, minus the html parsing on every call. htmlfill runs a FillingParser over
+the page: HTMLParser tokenizes it and calls handle_starttag and friends, and those copy the
+source through, rewriting form fields as they go. The tokenizing only depends on the page,
+so we do it once per distinct page, record the calls (with the position the parser was at
+for each), and play them back into a fresh FillingParser for every fill. What comes out is
+whatever htmlfill.render would have made.
+
+    from pylons_common.web import formfill
+    html = formfill.render(html, defaults=..., errors=...)
+
+Pages are cached by a hash of their exact content, so a form that renders the same markup
+every time (the values come from the defaults) gets the benefit. Anything in the page that
+changes per request (a csrf token, the user's name) makes it a new page. Recording costs more
+than a plain htmlfill.render, so a page is only recorded the second time it is seen; until
+then it goes to htmlfill.render, and one-off pages dont push the useful ones out.
+
+check_render() compares the output with htmlfill.render's, benchmark() times them.
+"""
+
+__all__ = ['render', 'parse', 'ParsedForm', 'check_render', 'benchmark']
+
+# Distinct pages to keep parsed
+MAX_PARSED_FORMS = 100
+# Distinct pages to remember having seen once. Only their hashes are kept.
+MAX_SEEN_FORMS = 1000
+
+_parsed_forms = LRUCache(MAX_PARSED_FORMS)
+_seen_forms = LRUCache(MAX_SEEN_FORMS)
+
+# The only tags FillingParser does anything with. Every other tag, like text and comments,
+# just gets the source up to it copied through (or skipped, inside a form:iferror and such).
+FORM_START_TAGS = set(['input', 'textarea', 'select', 'option', 'form:error', 'form:iferror'])
+FORM_END_TAGS = set(['textarea', 'select', 'form:error', 'form:iferror'])
+
+def compact(events):
+    """
+    Cuts down a recorded parse to what makes a difference to FillingParser. Of a run of events
+    that only copy the source through, the first (it may be skipping what came before it) and
+    the last are enough: the ones in between just copy smaller pieces of the same text.
+    """
+    compacted = []
+    run = 0
+    for name, args, pos in events:
+        if name == 'handle_misc' or \
+           (name == 'handle_endtag' and args[0] not in FORM_END_TAGS) or \
+           (name in ('handle_starttag', 'handle_startendtag') and args[0] not in FORM_START_TAGS):
+            event = ('handle_misc', (None,), pos)
+            if run >= 2:
+                compacted[-1] = event
+            else:
+                compacted.append(event)
+            run += 1
+        else:
+            compacted.append((name, args, pos))
+            run = 0
+    return compacted
+
+class ParsedForm(object):
+    """
+    The recorded parse of a page. events is [(handler name, args, (line, offset))] in the
+    order HTMLParser made the calls, end is the position it finished at. The page itself is
+    only kept split into lines, which is all FillingParser reads it from.
+    """
+    def __init__(self, form, events, end):
+        self.data_is_str = isinstance(form, str)
+        self.lines = form.split('\n')
+        self.events = events
+        self.end = end
+    
+    def fill(self, parser):
+        """
+        Plays the parse into parser (a FillingParser that hasnt been fed) and closes it.
+        """
+        # what RewritingParser.feed does before handing off to HTMLParser
+        parser.data_is_str = self.data_is_str
+        # feed keeps the whole page in source too, but nothing reads it
+        parser.source = None
+        parser.lines = self.lines
+        parser.source_pos = 1, 0
+        
+        for name, args, pos in self.events:
+            parser.lineno, parser.offset = pos
+            if name in ('handle_starttag', 'handle_startendtag'):
+                # the handlers change attrs in place
+                args = (args[0], list(args[1]))
+            getattr(parser, name)(*args)
+        
+        parser.lineno, parser.offset = self.end
+        parser.close()
+        return parser.text()
+
+class RecordingParser(htmlfill.FillingParser):
+    """
+    A FillingParser that only records what HTMLParser calls. It is a FillingParser so the
+    tokenizing (its unescape and all) is exactly the same.
+    """
+    def __init__(self):
+        htmlfill.FillingParser.__init__(self, {})
+        self.events = []
+    
+    def record(self, name, *args):
+        self.events.append((name, args, self.getpos()))
+    
+    def handle_starttag(self, tag, attrs):
+        self.record('handle_starttag', tag, tuple(attrs))
+    
+    def handle_startendtag(self, tag, attrs):
+        self.record('handle_startendtag', tag, tuple(attrs))
+    
+    def handle_endtag(self, tag):
+        self.record('handle_endtag', tag)
+    
+    def handle_misc(self, whatever):
+        # every other handler in RewritingParser is handle_misc, and only uses the position
+        self.record('handle_misc', whatever)
+    
+    handle_data = handle_charref = handle_entityref = handle_comment = handle_misc
+    handle_decl = handle_pi = unknown_decl = handle_misc
+
+def form_key(form):
+    if isinstance(form, unicode):
+        return (unicode, hashlib.md5(form.encode('utf-8')).digest())
+    return (str, hashlib.md5(form).digest())
+
+def parse(form):
+    """
+    The ParsedForm for form, from the cache if we have seen this page before. None if it
+    cant be played back (HTMLParser still had something to say when it was closed), or if
+    this is the first time we've seen it.
+    """
+    key = form_key(form)
+    parsed = _parsed_forms.get(key)
+    if parsed is not None:
+        return parsed or None
+    
+    if not _seen_forms.get(key):
+        _seen_forms.set(key, True)
+        return None
+    _seen_forms.delete(key)
+    
+    recorder = RecordingParser()
+    # HTMLParser's feed, not RewritingParser's. It doesnt need the source lines split up.
+    HTMLParser.HTMLParser.feed(recorder, form)
+    end = recorder.getpos()
+    
+    # what HTMLParser.close does with anything it was holding back
+    n = len(recorder.events)
+    if recorder.rawdata:
+        recorder.goahead(1)
+    if len(recorder.events) > n:
+        # close() would have written out the source up to end before these. Let htmlfill do it.
+        logger.debug('Not caching a form that ends in an incomplete tag')
+        parsed = False
+    else:
+        parsed = ParsedForm(form, compact(recorder.events), end)
+    
+    _parsed_forms.set(key, parsed)
+    return parsed or None
+
+def render(form, defaults=None, errors=None, **kwargs):
+    """
+    Takes the same arguments, and gives the same result, as htmlfill.render.
+    """
+    if kwargs.get('listener'):
+        # listeners watch the parse itself
+        return htmlfill.render(form, defaults=defaults, errors=errors, **kwargs)
+    
+    parsed = parse(form)
+    if not parsed:
+        return htmlfill.render(form, defaults=defaults, errors=errors, **kwargs)
+    
+    # htmlfill.render's defaults
+    if defaults is None:
+        defaults = {}
+    if kwargs.get('auto_insert_errors', True) and kwargs.get('auto_error_formatter') is None:
+        kwargs['auto_error_formatter'] = htmlfill.default_formatter
+    kwargs.pop('auto_insert_errors', None)
+    
+    return parsed.fill(htmlfill.FillingParser(defaults=defaults, errors=errors, **kwargs))
+
+##
+## Checking and timing against htmlfill
+##
+
+def sample_forms(n=1000, seed=0):
+    """
+    n pages made of random pieces of markup: every kind of field, form:error and form:iferror,
+    text, entities, comments, scripts, tags split over lines, and some that end in the middle
+    of a tag. About a third are str, the rest unicode.
+    """
+    import random
+    r = random.Random(seed)
+    
+    pieces = [
+        u'<form action="/x" method="post">', u'</form>', u'\n', u'  ', u'text &amp; more', u'&copy;', u'&#169;',
+        u'<input type="text" name="name" value="old">', u'<input type="text" name="email" />', u'<input name="notype">',
+        u'<input type="hidden" name="h" value="1">', u'<input type="password" name="pw" value="secret">',
+        u'<input type="checkbox" name="cb" value="a" checked>', u'<input type="checkbox" name="cb" value="b">',
+        u'<input type="radio" name="r" value="x" checked="checked">', u'<input type="radio" name="r" value="y">',
+        u'<input type="submit" name="go" value="Go">', u'<textarea name="ta">old text</textarea>',
+        u'<select name="s"><option value="1">One</option><option value="2" selected>Two</option></select>',
+        u'<select name="m" multiple>\n<option value="a">A</option>\n<option value="b">B</option>\n</select>',
+        u'<form:error name="name">', u'<form:iferror name="email">bad email <form:error name="email"></form:iferror>',
+        u'<form:iferror name="not name">name ok</form:iferror>', u'<!-- comment -->', u'<!DOCTYPE html>',
+        u'<script>if (a < b) { x = "<input>"; }</script>', u'<p class="x">para</p>', u'<br/>',
+        u'<div\nclass="multi\nline">', u'</div>', u'<INPUT TYPE="TEXT" NAME="name">', u'\xe9 \xfc \xf1',
+    ]
+    
+    forms = []
+    for i in range(n):
+        form = u''.join(r.choice(pieces) for j in range(r.randint(0, 30)))
+        if r.random() < 0.05:
+            form += r.choice([u'<inp', u'&am', u'<!-- open', u'<'])
+        if r.random() < 0.3:
+            form = form.encode('utf-8')
+        forms.append(form)
+    return forms
+
+def check_render(forms=None):
+    """
+    Fills forms (sample_forms() by default) with render, three ways each so the pass through,
+    recording and cached fills are all checked, and with htmlfill.render. Returns
+    [(form, defaults, errors, expected, got)] for every fill they disagree on, where a failure
+    is the exception's class.
+    """
+    def result(fn, form, defaults, errors, kwargs):
+        try:
+            return fn(form, defaults=defaults, errors=errors, **kwargs)
+        except Exception, e:
+            return e.__class__
+    
+    if forms is None:
+        forms = sample_forms()
+    
+    fills = [
+        ({}, None, {}),
+        ({'name': u'Bob <b>', 'email': 'x@y.com', 'cb': ['a'], 'r': 'y', 's': '1', 'm': ['a', 'b'], 'ta': u'new & text'},
+         {'name': u'Required', 'email': 'Bad <email>'}, {'encoding': 'utf-8'}),
+        ({'name': 5, 's': 2, 'cb': 'b'}, 'form level', {'prefix_error': False, 'auto_insert_errors': False}),
+    ]
+    
+    mismatches = []
+    for form in forms:
+        for defaults, errors, kwargs in fills:
+            expected = result(htmlfill.render, form, defaults, errors, kwargs)
+            got = result(render, form, defaults, errors, kwargs)
+            if got != expected:
+                mismatches.append((form, defaults, errors, expected, got))
+    return mismatches
+
+def benchmark(form=None, defaults=None, number=100):
+    """
+    Times filling form number times with htmlfill.render, with render once it has the page
+    recorded, and with render on a page it hasnt seen before every time. With no form this
+    uses a settings page with 300 fields. Returns {name: seconds}.
+    """
+    import random
+    import timeit
+    
+    if form is None:
+        rows = []
+        for i in range(300):
+            rows.append('<label for="f%d">Field %d</label>\n<input type="text" id="f%d" name="f%d" value="">\n<form:error name="f%d">' % (i, i, i, i, i))
+        form = '<html><body><p>%s</p><form method="post">\n%s\n</form></body></html>' % ('lorem ipsum &amp; dolor ' * 200, '\n'.join(rows))
+        defaults = dict(('f%d' % i, 'value %d' % i) for i in range(300))
+    
+    # a comment on the end makes each one a new page, without changing what gets filled
+    salt = random.random()
+    unseen = ['%s<!-- %r %d -->' % (form, salt, i) for i in range(number)]
+    render(form, defaults)
+    render(form, defaults)
+    
+    times = {}
+    for name, fn in [('htmlfill', lambda: htmlfill.render(form, defaults)),
+                     ('cached', lambda: render(form, defaults)),
+                     ('unseen', lambda: render(unseen.pop(), defaults))]:
+        times[name] = timeit.Timer(fn).timeit(number)
+        logger.info('%s: %.3fsec for %d runs' % (name, times[name], number))
+    return times
@@ -1,15 +1,18 @@
 
 import formencode
 
-from formencode import htmlfill
 from paste.httpexceptions import HTTPException
-import pylons, time
+import pylons, time, hashlib
 from pylons import tmpl_context as c, request, response
 from pylons.templating import render_mako
 
 # our junk
 from pylons_common.lib.exceptions import *
+from pylons_common.lib import serialize
+from pylons_common.lib.utils import dict_view, list_view
+from pylons_common.lib.timeline import get_timeline, timer
 from pylons_common.lib.log import create_logger
+from pylons_common.web import formfill
 logger = create_logger('pylons_common.web.response')
 
 from decorator import decorator
@@ -27,6 +30,15 @@ ERROR_HTTP_STATUS = {
 
 MAX_DEBUG_REQUESTS = 200
 
+# Return this from a function wrapped in ajax to send an empty 304 without serializing anything.
+NOT_MODIFIED = object()
+
+# Set this in the environ to have ajax send an ETag hashed from the response body.
+ETAG_ENVIRON_KEY = 'pylons_common.etag'
+
+# Approximate number of bytes buffered before a chunk of a streamed (csv or json) response is sent.
+STREAM_CHUNK_SIZE = 64 * 1024
+
 def htmlfill_error_formatter(error):
     """
     An error formatter to make the errors consistent with the js validate errors.
@@ -35,14 +47,177 @@ def htmlfill_error_formatter(error):
     return '<div class="error-container"><label class="error">%s</label></div>' % (html_quote(error))
 
 def _jsonify(d):
-    import simplejson
-    return simplejson.dumps(d)
+    return serialize.dumps(d)
+
+def _is_streamable(results):
+    """
+    Generators, queries and other lazy iterables get streamed rather than encoded in one go.
+    """
+    return hasattr(results, '__iter__') and \
+           not isinstance(results, (list, tuple, dict, basestring, dict_view, list_view))
+
+def _unwrap(value):
+    """
+    The dict or list under an objectify_view, otherwise value.
+    """
+    if isinstance(value, (dict_view, list_view)):
+        return value._data
+    return value
+
+def _jsonify_iter(d):
+    """
+    Encodes the ajax envelope d incrementally, yielding chunks of about STREAM_CHUNK_SIZE
+    bytes. d['results'] is consumed one item at a time, so neither the full result list nor
+    the full string is ever in memory.
+    """
+    encoder = serialize.get_encoder()
+    
+    chunk = ['{']
+    for key, value in d.iteritems():
+        if key != u'results':
+            chunk.append('%s: %s, ' % (encoder.encode(key), encoder.encode(value)))
+    chunk.append('"results": [')
+    size = 0
+    
+    first = True
+    for item in d[u'results']:
+        item = encoder.encode(item)
+        if not first:
+            chunk.append(', ')
+        chunk.append(item)
+        first = False
+        
+        size += len(item)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    
+    chunk.append(']}')
+    yield ''.join(chunk)
+
+def _timed_stream(chunks):
+    """
+    Passes a streamed response's chunks through, and logs the time spent making them (not the
+    time spent sending them) once it is done. The Server-Timing header and the debug block
+    have gone out by then, so the log is the only place it can go.
+    """
+    elapsed = 0.0
+    chunks = iter(chunks)
+    while True:
+        t = timer()
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            break
+        finally:
+            elapsed += timer() - t
+        yield chunk
+    logger.info('Serialized streamed response in %.3fsec' % elapsed)
+
+def _is_csvable(results):
+    """
+    Can results be rendered as csv rows? Lists, lazy iterables and queries of rows, or a single
+    dict or model object. Strings and other scalars cant.
+    """
+    results = _unwrap(results)
+    return isinstance(results, (list, tuple, dict)) or hasattr(results, '__table__') or _is_streamable(results)
+
+def _csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode('utf-8')
+
+def _csv_header(row):
+    """
+    Column names for a row, or None if the row is a plain sequence.
+    """
+    if isinstance(row, dict):
+        return sorted(row.keys())
+    if hasattr(row, 'keys'):
+        # RowProxy and friends from a sqlalchemy query
+        return list(row.keys())
+    if hasattr(row, '__table__'):
+        return [column.key for column in row.__table__.columns]
+    return None
+
+def _csv_values(row, header):
+    if header and isinstance(row, dict):
+        return [row.get(k) for k in header]
+    if hasattr(row, 'keys') or isinstance(row, (list, tuple)):
+        return list(row)
+    if header:
+        return [getattr(row, k, None) for k in header]
+    # a list of scalars is one column
+    return [row]
+
+def _csvify(rows):
+    """
+    Renders rows as csv, yielding chunks of about STREAM_CHUNK_SIZE bytes. rows can be a
+    list, generator or sqlalchemy query of dicts, sequences, result rows or model objects.
+    The header is written once from the first row. Only one chunk is in memory at a time.
+    
+    Note the rows are consumed after the action returns, so a query should still be
+    usable at that point.
+    """
+    import csv
+    from cStringIO import StringIO
+    
+    rows = _unwrap(rows)
+    if isinstance(rows, dict) or hasattr(rows, '__table__'):
+        rows = [rows]
+    
+    buf = StringIO()
+    writer = csv.writer(buf)
+    header = None
+    first = True
+    for row in rows:
+        row = _unwrap(row)
+        if first:
+            header = _csv_header(row)
+            if header:
+                writer.writerow([_csv_cell(k) for k in header])
+            first = False
+        
+        writer.writerow([_csv_cell(v) for v in _csv_values(row, header)])
+        
+        if buf.tell() >= STREAM_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    
+    if buf.tell():
+        yield buf.getvalue()
+
+def etag_matches(if_none_match, etag):
+    """
+    Does an If-None-Match header value match etag? Weak validators match too.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
 
 def format_results(results, format):
     
     if format == FORMAT_JSON:
         content_type = 'text/json'
-        formatted_results = _jsonify(results)
+        if _is_streamable(results.get(u'results')):
+            formatted_results = _jsonify_iter(results)
+        else:
+            formatted_results = _jsonify(results)
+    elif format == FORMAT_CSV and _is_csvable(results.get(u'results')):
+        content_type = 'text/csv'
+        formatted_results = _csvify(results[u'results'])
     else:
         content_type = 'text/json'
         formatted_results = _jsonify(results)
@@ -57,6 +232,7 @@ def ajax(func, *args, **kwargs):
     including returning controller exceptions.
     """
     render_start = time.time()
+    timeline = get_timeline(request.environ)
     
     request.environ['is_async'] = True
     
@@ -87,6 +263,10 @@ def ajax(func, *args, **kwargs):
     try:
         result = func(*args, **kwargs)
         
+        # The client's copy is current. Nothing to serialize.
+        if result is NOT_MODIFIED:
+            return ''
+        
         if result == True:
             result = {u'status': STATUS_SUCCESS}
         elif result == False:
@@ -183,20 +363,48 @@ def ajax(func, *args, **kwargs):
     if request.environ.get('QUERY_STRING'):
         requested_url += '?' + request.environ['QUERY_STRING']
     
+    # A streamed response (a generator or query in results) is only encoded as it is sent,
+    # after this. Queries it runs then arent in the debug block, and the serialize span only
+    # covers setting it up; _timed_stream logs the rest.
     debug = request.environ.get('show_debug', False)
     if debug and c.queries:
+        from pylons_common.sqlalchemy.proxy import summarize_queries
+        
         length = len(c.queries)
-        queries = sorted(c.queries, key=lambda x: -x[1])
+        queries = sorted(c.queries, key=lambda q: -q.time)
         result['debug'] = {
             'queries': length,
             'query_time': c.query_time or 0,
             'total_time': time.time() - render_start,
             'requested_url': requested_url,
-            'query_data': [{'query': q, 'time': t} for q, t in queries[:MAX_DEBUG_REQUESTS]]
+            'query_data': [{'query': q.sql(), 'time': q.time} for q in queries[:MAX_DEBUG_REQUESTS]],
+            'query_summary': summarize_queries(c.queries)[:MAX_DEBUG_REQUESTS]
         }
         logger.info('ASYNC queries: %s; qtime: %.3fsec; total time: %.3fsec' % (result['debug']['queries'], result['debug']['query_time'], result['debug']['total_time']))
+    
+    if debug and getattr(c, 'n_plus_one', None):
+        from pylons_common.sqlalchemy.proxy import n_plus_one_report
+        result.setdefault('debug', {})['n_plus_one'] = n_plus_one_report(c)
         
-    return format_results(result, format)
+    if debug:
+        result.setdefault('debug', {})['timeline'] = timeline.totals()
+    
+    t = timer()
+    formatted_results = format_results(result, format)
+    timeline.mark('serialize', t)
+    if not isinstance(formatted_results, basestring):
+        formatted_results = _timed_stream(formatted_results)
+    response.headers['Server-Timing'] = timeline.server_timing()
+    
+    # ApiMixin.dispatch asks for this on GETs where the api function gave no version hint
+    if request.environ.get(ETAG_ENVIRON_KEY) and isinstance(formatted_results, basestring) and response.status_int == 200:
+        etag = '"%s"' % hashlib.md5(formatted_results).hexdigest()
+        response.headers['ETag'] = etag
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            response.status = 304
+            formatted_results = ''
+    
+    return formatted_results
 ajax = decorator(ajax)
 
 def dispatch_on(**method_map):
@@ -313,7 +521,7 @@ def mixed_response(sync_error_action=None, prefix_error=False,
                     htmlfill_kwargs2.setdefault('prefix_error', prefix_error)
                     htmlfill_kwargs2.setdefault('auto_error_formatter', auto_error_formatter)
                     
-                    return htmlfill.render(response, defaults=params, errors=errs,
+                    return formfill.render(response, defaults=params, errors=errs,
                                            **htmlfill_kwargs2)
         return new
     return dec
@@ -338,5 +546,5 @@ def render_response(*args, **kw):
     # pylons does htmlfill.render on pages that have errors, so don't do it here (pylons.decorators.__init__.py line 183)
     if not c.form_errors:
         if form_defaults:
-            content = htmlfill.render(content, defaults=form_defaults, encoding="utf-8")
+            content = formfill.render(content, defaults=form_defaults, encoding="utf-8")
     return content
\ No newline at end of file